@@ -0,0 +1,72 @@
+import asyncio
+import os
+import socket
+
+import pytest
+from wipac_dev_tools import from_environment
+import motor.motor_asyncio
+
+from pubs.server import create_server
+
+from .corpus import seed_corpus
+
+default_config = {
+    'BENCH_DB_URL': 'mongodb://localhost/pub_db_bench',
+    'BENCH_SIZES': '1000,10000,100000',
+    'BENCH_SEED': 0,
+}
+config = from_environment(default_config)
+SIZES = [int(s) for s in config['BENCH_SIZES'].split(',') if s]
+
+@pytest.fixture(scope='session')
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+
+@pytest.fixture(scope='session')
+def mongo_client(loop):
+    db_url = config['BENCH_DB_URL'].rsplit('/', 1)[0]
+    client = motor.motor_asyncio.AsyncIOMotorClient(db_url, serverSelectionTimeoutMS=2000)
+    try:
+        loop.run_until_complete(client.admin.command('ping'))
+    except Exception:
+        pytest.skip('mongod is not reachable')
+    return client
+
+@pytest.fixture(scope='session', params=SIZES, ids=lambda n: f'{n}pubs')
+def corpus(request, loop, mongo_client):
+    """A database seeded with a synthetic corpus, one per size"""
+    db_name = config['BENCH_DB_URL'].rsplit('/', 1)[1]
+    db = mongo_client[f'{db_name}_{request.param}']
+    loop.run_until_complete(seed_corpus(db, request.param, seed=config['BENCH_SEED']))
+    return db
+
+@pytest.fixture(scope='session')
+def server(loop, corpus):
+    """A server on the corpus, with the query cache disabled"""
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('', 0))
+    port = s.getsockname()[1]
+    s.close()
+
+    env = {
+        'PORT': str(port),
+        'DB_URL': f'{config["BENCH_DB_URL"].rsplit("/", 1)[0]}/{corpus.name}',
+        'CACHE_SIZE': '0',
+        'FRAGMENT_CACHE_SIZE': '0',
+    }
+    old_env = {k: os.environ.get(k) for k in env}
+    os.environ.update(env)
+    try:
+        server = create_server(run_startup=False)
+    finally:
+        for k, v in old_env.items():
+            if v is None:
+                del os.environ[k]
+            else:
+                os.environ[k] = v
+
+    yield f'http://localhost:{port}'
+    loop.run_until_complete(server.stop())
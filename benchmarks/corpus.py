@@ -0,0 +1,61 @@
+"""
+Reproducible synthetic publication corpora
+"""
+import random
+import string
+
+from pubs import PUBLICATION_TYPES, PROJECTS, SITES
+from pubs.utils import import_pubs, validate_import, create_indexes
+
+def make_words(rand, n):
+    return [''.join(rand.choices(string.ascii_lowercase, k=rand.randint(3, 10))) for _ in range(n)]
+
+def make_pubs(n, seed=0):
+    """
+    Make `n` random publications, the same for each seed.
+
+    Field distributions are loosely based on the production data:
+    mostly journal articles, a few authors drawn from a large pool,
+    and dates spread over the last 25 years.
+    """
+    rand = random.Random(seed)
+    words = make_words(rand, 5000)
+    authors = [f'{a.title()}, {b[0].upper()}.' for a, b in zip(make_words(rand, 3000), make_words(rand, 3000))]
+    types = list(PUBLICATION_TYPES)
+    projects = list(PROJECTS)
+    sites = list(SITES)
+
+    pubs = []
+    for i in range(n):
+        pubs.append({
+            'title': ' '.join(rand.choices(words, k=rand.randint(5, 15))),
+            'authors': rand.sample(authors, rand.choice([1, 1, 2, 3, 5, 10])),
+            'type': rand.choices(types, weights=[10, 5, 2, 1, 1][:len(types)])[0],
+            'abstract': ' '.join(rand.choices(words, k=rand.randint(0, 200))),
+            'citation': ' '.join(rand.choices(words, k=4)) + f' {rand.randint(1, 999)}',
+            'date': f'{rand.randint(2000, 2025)}-{rand.randint(1, 12):02d}-{rand.randint(1, 28):02d}T00:00:00',
+            'downloads': [f'https://{rand.choice(words)}.org/{rand.choice(words)}.pdf' for _ in range(rand.randint(0, 2))],
+            'projects': sorted(rand.sample(projects, rand.choice([1, 1, 1, 2]))),
+            'sites': sorted(rand.sample(sites, rand.choice([0, 1, 1, 2]))),
+        })
+    return pubs
+
+async def seed_corpus(db, n, seed=0):
+    """
+    Fill a database with a synthetic corpus, unless it already has it.
+
+    The corpus is recorded in the metadata collection, so repeat runs
+    against the same database skip the (slow) seeding.
+    """
+    marker = {'_id': 'benchmark_corpus', 'size': n, 'seed': seed}
+    if await db.metadata.find_one(marker) and await db.publications.estimated_document_count() == n:
+        return
+    await db.publications.drop()
+    await db.authors.drop()
+    await db.metadata.drop()
+    pubs = make_pubs(n, seed)
+    for p in pubs:
+        validate_import(p)
+    await import_pubs(db, pubs)
+    await create_indexes(db, background=False)
+    await db.metadata.replace_one({'_id': 'benchmark_corpus'}, marker, upsert=True)
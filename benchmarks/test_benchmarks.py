@@ -0,0 +1,70 @@
+import json
+from unittest.mock import Mock
+
+import pytest
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httputil import HTTPServerRequest
+from tornado.web import Application
+
+from pubs.server import BaseHandler, csv_formatter
+from pubs.utils import date_format, validate, try_import_file
+
+from .corpus import make_pubs
+
+PUBS = make_pubs(1000, seed=1)
+SEARCH = PUBS[0]['title'].split()[0]
+
+# query shapes for get_pubs, as url arguments
+QUERIES = {
+    'all': '',
+    'project': 'projects=icecube',
+    'project_site': 'projects=icecube&sites=wipac',
+    'type_date': 'type=thesis&start_date=2010-01-01&end_date=2015-01-01',
+    'author': 'authors=' + PUBS[0]['authors'][0],
+    'search': 'search=' + SEARCH,
+    'deep_page': 'page=50&limit=100',
+}
+
+def make_handler(uri):
+    request = HTTPServerRequest(method='GET', uri=uri, connection=Mock())
+    return BaseHandler(Application(), request)
+
+def test_date_format(benchmark):
+    benchmark(date_format, '2020-11-03T00:00:00')
+
+def test_validate(benchmark):
+    def run():
+        for p in PUBS:
+            validate(p['title'], p['authors'], p['type'], p['abstract'], p['citation'], p['date'], p['downloads'], p['projects'], p['sites'])
+    benchmark(run)
+
+@pytest.mark.parametrize('query', list(QUERIES.values()), ids=list(QUERIES))
+def test_args_to_match_query(benchmark, query):
+    handler = make_handler('/api/publications?' + query)
+    benchmark(handler.args_to_match_query)
+
+def test_csv_rows(benchmark):
+    _, format_row = csv_formatter()
+    benchmark(lambda: [format_row(p) for p in PUBS])
+
+def test_try_import_file(benchmark, loop, mongo_client):
+    db = mongo_client['pub_db_bench_import']
+    data = json.dumps(PUBS)
+
+    def setup():
+        loop.run_until_complete(db.publications.drop())
+        loop.run_until_complete(db.authors.drop())
+
+    benchmark.pedantic(lambda: loop.run_until_complete(try_import_file(db, data)), setup=setup, rounds=5)
+    setup()
+
+@pytest.mark.parametrize('query', list(QUERIES.values()), ids=list(QUERIES))
+def test_get_pubs(benchmark, loop, server, query):
+    client = AsyncHTTPClient()
+    url = f'{server}/api/publications?limit=100&{query}'
+    benchmark(lambda: loop.run_until_complete(client.fetch(url)))
+
+def test_csv_export(benchmark, loop, server):
+    client = AsyncHTTPClient()
+    url = f'{server}/csv'
+    benchmark.pedantic(lambda: loop.run_until_complete(client.fetch(url)), rounds=5)
@@ -1,5 +1,10 @@
 import asyncio
 import logging
+import os
+import signal
+import socket
+import sys
+import time
 
 from wipac_dev_tools import from_environment
 
@@ -18,14 +23,109 @@ setlevel = {
 
 default_config = {
     'LOG_LEVEL': 'INFO',
+    'WORKERS': 1,  # server processes sharing the port
+    'SHUTDOWN_TIMEOUT': 10,  # seconds to wait for requests in flight
 }
 config = from_environment(default_config)
 if config['LOG_LEVEL'].upper() not in setlevel:
     raise Exception('LOG_LEVEL is not a proper log level')
-logformat = '%(asctime)s %(levelname)s %(name)s %(module)s:%(lineno)s - %(message)s'
+if config['WORKERS'] < 1:
+    raise Exception('WORKERS must be at least 1')
+if config['WORKERS'] > 1 and not hasattr(socket, 'SO_REUSEPORT'):
+    raise Exception('WORKERS > 1 requires SO_REUSEPORT support')
+logformat = '%(asctime)s %(levelname)s {tag}%(name)s %(module)s:%(lineno)s - %(message)s'
+
+logging.basicConfig(format=logformat.format(tag=''), level=setlevel[config['LOG_LEVEL'].upper()])
+
+
+def run_worker(worker_id=None):
+    """Run a server process until it is signaled to stop"""
+    if worker_id is not None:
+        logging.basicConfig(format=logformat.format(tag=f'[worker{worker_id}] '),
+                            level=setlevel[config['LOG_LEVEL'].upper()], force=True)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    # the migration and index build only needs to run once
+    server = create_server(reuse_port=worker_id is not None, run_startup=not worker_id)
+
+    async def shutdown():
+        logging.info('shutting down')
+        await server.stop(timeout=config['SHUTDOWN_TIMEOUT'])
+        loop.stop()
+
+    def handle_signal():
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.remove_signal_handler(sig)
+        loop.create_task(shutdown())
+
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, handle_signal)
+
+    loop.run_forever()
+    loop.close()
+
+
+def fork_worker(worker_id):
+    pid = os.fork()
+    if pid == 0:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        code = 0
+        try:
+            run_worker(worker_id)
+        except Exception:
+            logging.error('worker failed', exc_info=True)
+            code = 1
+        finally:
+            logging.shutdown()
+            os._exit(code)
+    logging.info('started worker %d, pid %d', worker_id, pid)
+    return pid
+
+
+def supervise(num_workers):
+    """Fork the workers, restarting any that crash, until signaled to stop"""
+    stopping = False
+    children = {}
+
+    def handle_signal(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the terminal sends this to every worker
+
+    for i in range(num_workers):
+        children[fork_worker(i)] = i
+    signal.signal(signal.SIGINT, handle_signal)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        worker_id = children.pop(pid, None)
+        if worker_id is None:
+            continue
+        exitcode = os.waitstatus_to_exitcode(status)
+        if stopping:
+            logging.info('worker %d exited', worker_id)
+        else:
+            logging.warning('worker %d exited unexpectedly with %d, restarting', worker_id, exitcode)
+            time.sleep(1)
+            if not stopping:
+                children[fork_worker(worker_id)] = worker_id
+    return 0
 
-logging.basicConfig(format=logformat, level=setlevel[config['LOG_LEVEL'].upper()])
 
 # start server
-create_server()
-asyncio.get_event_loop().run_forever()
+if config['WORKERS'] > 1:
+    sys.exit(supervise(config['WORKERS']))
+else:
+    run_worker()
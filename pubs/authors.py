@@ -0,0 +1,70 @@
+"""
+In-memory index of author names, for prefix suggestions
+"""
+
+import asyncio
+from bisect import bisect_left
+
+from unidecode import unidecode
+
+from .utils import get_revision
+
+def fold(name):
+    """Fold case and diacritics, so `Ä` matches `a`"""
+    return unidecode(name).casefold()
+
+class AuthorIndex:
+    """
+    A sorted index of folded author names.
+
+    Each name is indexed from the start of every word, so a prefix can
+    match either the first or last name. The index is rebuilt from the
+    author registry whenever the collection revision changes.
+    """
+    def __init__(self):
+        self.keys = []
+        self.names = []
+        self.revision = None
+        self.lock = asyncio.Lock()
+
+    def __len__(self):
+        return len(self.names)
+
+    def build(self, names):
+        entries = set()
+        for name in names:
+            words = fold(name).split()
+            for i in range(len(words)):
+                entries.add((' '.join(words[i:]), name))
+        entries = sorted(entries)
+        self.keys = [k for k, _ in entries]
+        self.names = [n for _, n in entries]
+
+    async def refresh(self, db, revision=None):
+        """Rebuild the index if the publications have changed"""
+        if revision is None:
+            revision, _ = await get_revision(db)
+        if revision == self.revision:
+            return
+        async with self.lock:
+            if revision == self.revision:
+                return
+            names = [row['_id'] async for row in db.authors.find({}, projection={'_id': True})]
+            self.build(names)
+            self.revision = revision
+
+    def suggest(self, prefix, limit=20):
+        """Get up to `limit` author names matching a prefix"""
+        prefix = ' '.join(fold(prefix).split())
+        if not prefix:
+            return []
+        ret = []
+        seen = set()
+        i = bisect_left(self.keys, prefix)
+        while i < len(self.keys) and self.keys[i].startswith(prefix) and len(ret) < limit:
+            name = self.names[i]
+            if name not in seen:
+                seen.add(name)
+                ret.append(name)
+            i += 1
+        return ret
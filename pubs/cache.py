@@ -0,0 +1,211 @@
+"""
+In-process cache for query results
+"""
+
+from collections import OrderedDict
+import json
+import time
+import weakref
+
+# every live cache, so writes can invalidate them all
+_caches = weakref.WeakSet()
+
+def invalidate_all():
+    """Clear all query caches, after a write to the publications"""
+    for cache in list(_caches):
+        cache.clear()
+
+def normalize_query(value):
+    """Normalize a mongo query so equivalent filters compare equal"""
+    if isinstance(value, dict):
+        return {k: normalize_query(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        ret = [normalize_query(v) for v in value]
+        if all(isinstance(v, str) for v in ret):
+            ret.sort()
+        return ret
+    return value
+
+def make_key(*parts):
+    """Make a cache key out of query parts"""
+    return json.dumps([normalize_query(p) for p in parts], sort_keys=True, default=str, separators=(',', ':'))
+
+def approx_size(value, limit=0):
+    """
+    Cheaply estimate the size of a result in bytes.
+
+    Counts string lengths and a fixed size for anything else, without
+    serializing. Stops counting once over `limit`, if set.
+    """
+    size = 0
+    stack = [value]
+    while stack:
+        v = stack.pop()
+        if isinstance(v, str):
+            size += len(v)
+        elif isinstance(v, dict):
+            size += sum(len(k) for k in v)
+            stack.extend(v.values())
+        elif isinstance(v, (list, tuple)):
+            stack.extend(v)
+        else:
+            size += 8
+        if limit and size > limit:
+            break
+    return size
+
+class QueryCache:
+    """
+    A bounded LRU cache with a time-to-live.
+
+    Entries are evicted when either the number of entries or their
+    approximate total size is over the limit.
+
+    Args:
+        maxsize (int): max number of entries (0 disables the cache)
+        ttl (float): seconds an entry stays valid
+        maxbytes (int): max approximate total size of entries (0 for no limit)
+    """
+    def __init__(self, maxsize=256, ttl=60, maxbytes=64*1024*1024):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.size = 0
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        _caches.add(self)
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key):
+        """Get a value, or None if missing or expired"""
+        if not self.maxsize:
+            return None
+        try:
+            expires, value, size = self.data[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        if expires < time.monotonic():
+            del self.data[key]
+            self.size -= size
+            self.misses += 1
+            return None
+        self.data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        """Set a value, evicting the least recently used entries if full"""
+        if not self.maxsize:
+            return
+        size = approx_size(value, self.maxbytes) if self.maxbytes else 0
+        if self.maxbytes and size > self.maxbytes:
+            return
+        if key in self.data:
+            self.size -= self.data[key][2]
+        self.data[key] = (time.monotonic() + self.ttl, value, size)
+        self.data.move_to_end(key)
+        self.size += size
+        while len(self.data) > self.maxsize or (self.maxbytes and self.size > self.maxbytes):
+            _, (_, _, old) = self.data.popitem(last=False)
+            self.size -= old
+            self.evictions += 1
+
+    def clear(self):
+        self.data.clear()
+        self.size = 0
+
+    def stats(self):
+        return {
+            'size': len(self.data),
+            'maxsize': self.maxsize,
+            'bytes': self.size,
+            'maxbytes': self.maxbytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+# every live fragment cache, so edits can invalidate them
+_fragment_caches = weakref.WeakSet()
+
+def invalidate_fragments(*pub_ids):
+    """Drop cached fragments for publications that have changed"""
+    for cache in list(_fragment_caches):
+        for pub_id in pub_ids:
+            cache.discard(pub_id)
+
+class FragmentCache:
+    """
+    A memory-bounded LRU cache of rendered html per publication.
+
+    Entries are stored under the publication id, and are only valid
+    for a matching revision stamp.
+
+    Args:
+        maxbytes (int): max total size of cached html (0 disables the cache)
+    """
+    def __init__(self, maxbytes=32*1024*1024):
+        self.maxbytes = maxbytes
+        self.size = 0
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        _fragment_caches.add(self)
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, pub_id, rev, variant=''):
+        """Get rendered html, or None if missing or stale"""
+        if not self.maxbytes:
+            return None
+        key = (str(pub_id), variant)
+        entry = self.data.get(key)
+        if entry is None or entry[0] != rev:
+            self.misses += 1
+            return None
+        self.data.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, pub_id, rev, html, variant=''):
+        """Set rendered html, evicting the least recently used entries if full"""
+        if not self.maxbytes or len(html) > self.maxbytes:
+            return
+        key = (str(pub_id), variant)
+        if key in self.data:
+            self.size -= len(self.data[key][1])
+        self.data[key] = (rev, html)
+        self.data.move_to_end(key)
+        self.size += len(html)
+        while self.size > self.maxbytes:
+            _, (_, old) = self.data.popitem(last=False)
+            self.size -= len(old)
+            self.evictions += 1
+
+    def discard(self, pub_id):
+        """Remove all entries for a publication"""
+        pub_id = str(pub_id)
+        for key in [k for k in self.data if k[0] == pub_id]:
+            self.size -= len(self.data.pop(key)[1])
+
+    def clear(self):
+        self.data.clear()
+        self.size = 0
+
+    def stats(self):
+        return {
+            'size': len(self.data),
+            'bytes': self.size,
+            'maxbytes': self.maxbytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
@@ -0,0 +1,156 @@
+"""
+Live publication changes, from a MongoDB change stream
+"""
+
+import asyncio
+from contextlib import contextmanager
+import logging
+
+import pymongo.errors
+
+from . import FIELDS
+from .cache import invalidate_all, invalidate_fragments
+
+logger = logging.getLogger('changes')
+
+# events buffered per subscriber before it is dropped as too slow
+MAX_QUEUE_SIZE = 1000
+
+# error codes for a change stream that cannot run or resume
+NOT_REPLICA_SET = 40573
+HISTORY_LOST = 286
+
+def matches(filters, pub):
+    """Check a publication against project, site, and type filters"""
+    if (projects := filters.get('projects')) and not all(p in pub.get('projects', []) for p in projects):
+        return False
+    if (sites := filters.get('sites')) and not all(s in pub.get('sites', []) for s in sites):
+        return False
+    if (types := filters.get('type')) and pub.get('type') not in types:
+        return False
+    return True
+
+class ChangeFeed:
+    """
+    Tail the publications change stream.
+
+    Every change invalidates the in-process caches, including changes
+    made by other processes. Changes are also sent to subscribers as
+    events, filtered by project, site, and type.
+
+    Deletes do not include the old document, so they are sent to every
+    subscriber. Updates also lack the old document, so subscribers whose
+    filters the updated publication no longer matches get a `removed`
+    event instead, in case it matched before.
+
+    Args:
+        db (AsyncIOMotorDatabase): database
+    """
+    def __init__(self, db):
+        self.db = db
+        self.subscribers = {}
+        self.available = None  # unknown until the stream starts
+        self.started = asyncio.Event()
+        self.task = None
+
+    @contextmanager
+    def subscribe(self, filters=None):
+        """
+        Subscribe to change events.
+
+        Yields a queue of events, with None when the feed stops or
+        the subscriber falls too far behind.
+        """
+        queue = asyncio.Queue(maxsize=MAX_QUEUE_SIZE)
+        self.subscribers[queue] = filters if filters else {}
+        try:
+            yield queue
+        finally:
+            self.subscribers.pop(queue, None)
+
+    def close_subscriber(self, queue):
+        self.subscribers.pop(queue, None)
+        while True:
+            try:
+                queue.put_nowait(None)
+                return
+            except asyncio.QueueFull:
+                queue.get_nowait()
+
+    def dispatch(self, change):
+        """Handle one change stream event"""
+        op = change['operationType']
+        if op not in ('insert', 'update', 'replace', 'delete'):
+            # drop, rename, or invalidate
+            invalidate_all()
+            return
+
+        pub_id = change['documentKey']['_id']
+        invalidate_all()
+        invalidate_fragments(pub_id)
+
+        event = {'type': 'update' if op == 'replace' else op, '_id': str(pub_id)}
+        pub = change.get('fullDocument')
+        if pub:
+            event['publication'] = {k: pub[k] for k in FIELDS if k in pub and k != '_id'}
+        elif op != 'delete':
+            # deleted again before the lookup
+            return
+
+        removed = {'type': 'removed', '_id': event['_id']}
+        for queue, filters in list(self.subscribers.items()):
+            e = event
+            if pub and not matches(filters, pub):
+                if event['type'] != 'update':
+                    continue
+                e = removed
+            try:
+                queue.put_nowait(e)
+            except asyncio.QueueFull:
+                logger.info('dropping slow change subscriber')
+                self.close_subscriber(queue)
+
+    async def run(self):
+        """Tail the change stream, resuming after errors"""
+        token = None
+        delay = 1
+        while True:
+            try:
+                async with self.db.publications.watch(full_document='updateLookup', resume_after=token) as stream:
+                    self.available = True
+                    self.started.set()
+                    delay = 1
+                    async for change in stream:
+                        token = stream.resume_token
+                        self.dispatch(change)
+                    token = None  # invalidated, so start over
+            except asyncio.CancelledError:
+                raise
+            except pymongo.errors.OperationFailure as e:
+                if e.code == NOT_REPLICA_SET:
+                    logger.warning('change streams need a replica set, live changes are disabled')
+                    self.available = False
+                    self.started.set()
+                    return
+                if e.code == HISTORY_LOST:
+                    logger.warning('change stream history lost, restarting')
+                    token = None
+                    invalidate_all()
+                else:
+                    logger.warning('change stream failed', exc_info=True)
+            except pymongo.errors.PyMongoError:
+                logger.warning('change stream failed', exc_info=True)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30)
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+
+    def stop(self):
+        """Stop tailing, and close all subscribers"""
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        for queue in list(self.subscribers):
+            self.close_subscriber(queue)
@@ -0,0 +1,306 @@
+"""
+Incremental parsing of uploaded publication files
+"""
+
+import codecs
+import csv
+import itertools
+import json
+
+from .utils import IMPORT_BATCH_SIZE, import_batch, parse_csv_row, validate_import
+
+# a single record larger than a mongo document cannot be valid
+MAX_RECORD_SIZE = 16 * 1024 * 1024
+
+BAD_FORMAT = 'File is not in a recognizable format. Only json or csv are valid.'
+
+
+class MultipartParser:
+    """
+    Incrementally split a multipart/form-data body.
+
+    The contents of file parts are passed through to `on_data`, with
+    `on_end` called after each file. Other form fields are ignored.
+
+    Args:
+        boundary (bytes): multipart boundary
+        on_data (callable): async function called with file data
+        on_end (callable): async function called at the end of each file
+    """
+    def __init__(self, boundary, on_data, on_end):
+        self.delimiter = b'\r\n--' + boundary
+        self.on_data = on_data
+        self.on_end = on_end
+        # the first boundary has no leading newline
+        self.buf = b'\r\n'
+        self.state = 'preamble'
+
+    async def feed(self, data):
+        self.buf += data
+        while self.buf:
+            if self.state in ('preamble', 'field', 'file'):
+                idx = self.buf.find(self.delimiter)
+                if idx < 0:
+                    # keep enough to match a delimiter split across chunks
+                    keep = len(self.delimiter) - 1
+                    if len(self.buf) > keep:
+                        if self.state == 'file':
+                            await self.on_data(self.buf[:-keep])
+                        self.buf = self.buf[-keep:]
+                    return
+                if self.state == 'file':
+                    await self.on_data(self.buf[:idx])
+                    await self.on_end()
+                self.buf = self.buf[idx+len(self.delimiter):]
+                self.state = 'boundary'
+            elif self.state == 'boundary':
+                if len(self.buf) < 2:
+                    return
+                if self.buf.startswith(b'--'):
+                    self.state = 'done'
+                    continue
+                idx = self.buf.find(b'\r\n')
+                if idx < 0:
+                    return
+                self.buf = self.buf[idx+2:]
+                self.state = 'headers'
+            elif self.state == 'headers':
+                idx = self.buf.find(b'\r\n\r\n')
+                if idx < 0:
+                    if len(self.buf) > 64 * 1024:
+                        raise Exception('multipart headers too long')
+                    return
+                headers = self.buf[:idx].lower()
+                self.state = 'file' if b'filename=' in headers else 'field'
+                self.buf = self.buf[idx+4:]
+            else:  # done, ignore the epilogue
+                self.buf = b''
+
+    def close(self):
+        if self.state != 'done':
+            raise Exception('incomplete multipart upload')
+
+
+class CSVStreamParser:
+    """Incrementally parse csv text into publications"""
+    def __init__(self):
+        self.buf = ''
+        self.record = ''
+        self.quotes = 0
+        self.header = None
+
+    def _parse_record(self):
+        record = self.record
+        self.record = ''
+        self.quotes = 0
+        row = next(csv.reader([record]), None)
+        if not row:
+            return None
+        if self.header is None:
+            self.header = row
+            return None
+        return parse_csv_row(dict(itertools.zip_longest(self.header, row)))
+
+    def feed(self, text):
+        self.buf += text
+        *lines, self.buf = self.buf.split('\n')
+        pubs = []
+        for line in lines:
+            self.record += line + '\n'
+            self.quotes += line.count('"')
+            # newlines inside quoted fields leave an odd number of quotes
+            if self.quotes % 2 == 0:
+                if (p := self._parse_record()) is not None:
+                    pubs.append(p)
+            elif len(self.record) > MAX_RECORD_SIZE:
+                raise Exception('csv record too large')
+        return pubs
+
+    def close(self):
+        self.record += self.buf
+        self.quotes += self.buf.count('"')
+        self.buf = ''
+        if self.quotes % 2:
+            raise Exception('unterminated quoted field in csv')
+        p = self._parse_record()
+        return [p] if p is not None else []
+
+
+class NeedMoreData(Exception):
+    pass
+
+
+class JSONStreamParser:
+    """
+    Incrementally parse json text into publications.
+
+    Accepts either a list of publications, or an object with a
+    `publications` list (like the output of `/api/publications`).
+    """
+    decoder = json.JSONDecoder()
+
+    def __init__(self):
+        self.buf = ''
+        self.pos = 0
+        self.state = 'start'
+        self.in_object = False
+        self.final = False
+
+    def _next_char(self):
+        while self.pos < len(self.buf) and self.buf[self.pos].isspace():
+            self.pos += 1
+        if self.pos >= len(self.buf):
+            raise NeedMoreData()
+        return self.buf[self.pos]
+
+    def _decode(self):
+        try:
+            val, end = self.decoder.raw_decode(self.buf, self.pos)
+        except json.JSONDecodeError:
+            if self.final or len(self.buf) - self.pos > MAX_RECORD_SIZE:
+                raise Exception(BAD_FORMAT)
+            raise NeedMoreData()
+        # a number may continue in the next chunk
+        if not isinstance(val, (dict, list, str)) and end >= len(self.buf) and not self.final:
+            raise NeedMoreData()
+        self.pos = end
+        return val
+
+    def _expect(self, chars):
+        c = self._next_char()
+        if c not in chars:
+            raise Exception(BAD_FORMAT)
+        self.pos += 1
+        return c
+
+    def _parse(self):
+        pubs = []
+        try:
+            while self.state != 'done':
+                if self.state == 'start':
+                    if self._expect('[{') == '[':
+                        self.state = 'array_first'
+                    else:
+                        self.in_object = True
+                        self.state = 'key_first'
+                elif self.state == 'key_first':
+                    if self._next_char() == '}':
+                        self.pos += 1
+                        self.state = 'done'
+                    else:
+                        self.state = 'key'
+                elif self.state == 'key':
+                    if self._next_char() != '"':
+                        raise Exception(BAD_FORMAT)
+                    start = self.pos
+                    try:
+                        key = self._decode()
+                        self._expect(':')
+                        if key == 'publications':
+                            self._expect('[')
+                    except NeedMoreData:
+                        self.pos = start
+                        raise
+                    self.state = 'array_first' if key == 'publications' else 'value'
+                elif self.state == 'value':
+                    self._next_char()
+                    self._decode()
+                    self.state = 'key_sep'
+                elif self.state == 'key_sep':
+                    if self._expect(',}') == ',':
+                        self.state = 'key'
+                    else:
+                        self.state = 'done'
+                elif self.state == 'array_first':
+                    if self._next_char() == ']':
+                        self.pos += 1
+                        self.state = 'key_sep' if self.in_object else 'done'
+                    else:
+                        self.state = 'element'
+                elif self.state == 'element':
+                    self._next_char()
+                    p = self._decode()
+                    if not isinstance(p, dict):
+                        raise Exception(BAD_FORMAT)
+                    pubs.append(p)
+                    self.state = 'elem_sep'
+                elif self.state == 'elem_sep':
+                    if self._expect(',]') == ',':
+                        self.state = 'element'
+                    else:
+                        self.state = 'key_sep' if self.in_object else 'done'
+        except NeedMoreData:
+            pass
+        self.buf = self.buf[self.pos:]
+        self.pos = 0
+        return pubs
+
+    def feed(self, text):
+        self.buf += text
+        return self._parse()
+
+    def close(self):
+        self.final = True
+        pubs = self._parse()
+        if self.state != 'done':
+            raise Exception(BAD_FORMAT)
+        return pubs
+
+
+class StreamImporter:
+    """
+    Import publications from file data as it arrives.
+
+    Each file is detected as json or csv from its first character.
+    Publications are validated as they are parsed, and upserted
+    in batches.
+
+    Args:
+        db (AsyncIOMotorDatabase): database
+        batch_size (int): publications per bulk write
+    """
+    def __init__(self, db, batch_size=IMPORT_BATCH_SIZE):
+        self.db = db
+        self.batch_size = batch_size
+        self.batch = []
+        self.files = 0
+        self.summary = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+        self._reset()
+
+    def _reset(self):
+        self.decoder = codecs.getincrementaldecoder('utf-8-sig')()
+        self.parser = None
+        self.head = ''
+
+    async def _add(self, pubs):
+        for p in pubs:
+            validate_import(p)
+            self.batch.append(p)
+            if len(self.batch) >= self.batch_size:
+                await self.flush()
+
+    async def feed(self, data):
+        text = self.decoder.decode(data)
+        if self.parser is None:
+            self.head += text
+            head = self.head.lstrip()
+            if not head:
+                return
+            self.parser = JSONStreamParser() if head[0] in '[{' else CSVStreamParser()
+            text, self.head = head, ''
+        await self._add(self.parser.feed(text))
+
+    async def end_file(self):
+        """Finish parsing the current file"""
+        text = self.decoder.decode(b'', final=True)
+        if self.parser is not None:
+            await self._add(self.parser.feed(text))
+            await self._add(self.parser.close())
+        self.files += 1
+        self._reset()
+
+    async def flush(self):
+        """Write the current batch to the database"""
+        batch, self.batch = self.batch, []
+        for k, v in (await import_batch(self.db, batch)).items():
+            self.summary[k] += v
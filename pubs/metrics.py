@@ -0,0 +1,145 @@
+"""
+Request and database metrics, in Prometheus text format
+"""
+
+from bisect import bisect_left
+from collections import Counter
+
+from pymongo import monitoring
+
+# seconds
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+def escape(value):
+    """Escape a label value"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in labels) + '}'
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+def format_metric(name, mtype, help, samples):
+    """
+    Format a metric family.
+
+    Args:
+        name (str): metric name
+        mtype (str): metric type
+        help (str): help text
+        samples (iterable): (suffix, labels, value) tuples
+    """
+    lines = [f'# HELP {name} {help}', f'# TYPE {name} {mtype}']
+    for suffix, labels, value in samples:
+        lines.append(f'{name}{suffix}{format_labels(labels)} {format_value(value)}')
+    return '\n'.join(lines) + '\n'
+
+class Histogram:
+    """
+    A histogram with fixed buckets, per set of label values.
+
+    Args:
+        name (str): metric name
+        help (str): help text
+        labelnames (tuple): label names
+        buckets (tuple): bucket upper bounds, in increasing order
+    """
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.data = {}
+
+    def observe(self, value, *labels):
+        """Record a value for the label values (in the order of `labelnames`)"""
+        try:
+            counts = self.data[labels]
+        except KeyError:
+            # per-bucket counts, then the sum
+            counts = self.data[labels] = [0] * (len(self.buckets) + 1) + [0.]
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def samples(self):
+        for labels, counts in sorted(self.data.items()):
+            labels = list(zip(self.labelnames, labels))
+            total = 0
+            for le, n in zip(self.buckets + ('+Inf',), counts):
+                total += n
+                yield '_bucket', labels + [('le', le)], total
+            yield '_sum', labels, counts[-1]
+            yield '_count', labels, total
+
+    def render(self):
+        return format_metric(self.name, 'histogram', self.help, self.samples())
+
+class CommandTimer(monitoring.CommandListener):
+    """Time mongo commands, for a client's `event_listeners`"""
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.histogram.observe(event.duration_micros / 1e6, event.command_name, 'success')
+
+    def failed(self, event):
+        self.histogram.observe(event.duration_micros / 1e6, event.command_name, 'failure')
+
+class Metrics:
+    """
+    Metrics for one server process.
+
+    Args:
+        caches (dict): name: cache, for caches with a `stats()` method
+    """
+    def __init__(self, caches=None):
+        self.caches = caches if caches else {}
+        self.requests = Histogram('pubs_request_duration_seconds', 'Request latency by handler and status',
+                                  ('handler', 'status'))
+        self.mongo = Histogram('pubs_mongo_command_duration_seconds', 'Mongo command latency by command and outcome',
+                               ('command', 'status'))
+        self.command_timer = CommandTimer(self.mongo)
+        self.in_flight = Counter()
+
+    def request_started(self, handler):
+        self.in_flight[handler] += 1
+
+    def request_finished(self, handler, status, duration):
+        self.in_flight[handler] -= 1
+        self.requests.observe(duration, handler, str(status))
+
+    def render(self):
+        """Get all metrics in Prometheus text format"""
+        ret = [
+            self.requests.render(),
+            format_metric('pubs_requests_in_flight', 'gauge', 'Requests currently being handled',
+                          (('', [('handler', k)], v) for k, v in sorted(self.in_flight.items()))),
+            self.mongo.render(),
+        ]
+
+        stats = {name: cache.stats() for name, cache in sorted(self.caches.items())}
+        for key, mtype, help in (
+            ('hits', 'counter', 'Cache hits'),
+            ('misses', 'counter', 'Cache misses'),
+            ('evictions', 'counter', 'Cache evictions'),
+            ('size', 'gauge', 'Cache entries'),
+            ('bytes', 'gauge', 'Approximate cache size in bytes'),
+        ):
+            suffix = '_total' if mtype == 'counter' else ''
+            ret.append(format_metric(f'pubs_cache_{key}{suffix}', mtype, help,
+                                     (('', [('cache', name)], s[key]) for name, s in stats.items())))
+
+        def ratio(s):
+            lookups = s['hits'] + s['misses']
+            return s['hits'] / lookups if lookups else 0.
+        ret.append(format_metric('pubs_cache_hit_ratio', 'gauge', 'Fraction of cache lookups that were hits',
+                                 (('', [('cache', name)], ratio(s)) for name, s in stats.items())))
+        return ''.join(ret)
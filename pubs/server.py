@@ -3,16 +3,23 @@ Server for publication db
 """
 
 import os
+import asyncio
 import logging
+import socket
+import time
 import binascii
 from functools import wraps
-from urllib.parse import urlparse
 import base64
 import csv
 from io import StringIO
 import itertools
+import json
+import hashlib
 
-from tornado.web import RequestHandler, HTTPError
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
+from tornado.web import Application, RequestHandler, HTTPError, stream_request_body
 from rest_tools.server import RestServer, catch_error
 from wipac_dev_tools import from_environment
 import motor.motor_asyncio
@@ -21,10 +28,50 @@ from bson.objectid import ObjectId
 
 from . import __version__ as version
 from . import PUBLICATION_TYPES, PROJECTS, SITES, FIELDS
-from .utils import create_indexes, date_format, add_pub, edit_pub, try_import_file
+from .authors import AuthorIndex
+from .changes import ChangeFeed
+from .cache import QueryCache, FragmentCache, make_key
+from .importer import MultipartParser, StreamImporter
+from .metrics import Metrics
+from .utils import INDEXES, create_indexes, migrate_display_fields, migrate_authors, parse_date, date_format, get_domain, add_pub, edit_pub, delete_pub, try_import_file, encode_after_token, decode_after_token, get_revision, bump_revision
 
 logger = logging.getLogger('server')
 
+# stored fields used for display, sorting, and caching, not part of the api
+INTERNAL_FIELDS = ['datetime', 'date_display', 'download_domains', 'rev']
+
+# sort arguments that use a different stored field
+SORT_FIELDS = {'date': 'datetime'}
+
+# text search score, for relevance sorting
+TEXT_SCORE = {'$meta': 'textScore'}
+
+# sort arguments allowed by the api
+API_SORTS = ('date', 'relevance')
+
+# max queries in one batch request
+BATCH_MAX_QUERIES = 20
+
+# seconds between keepalive comments on idle event streams
+SSE_KEEPALIVE = 15
+
+FILTER_DEFAULTS = {
+    'projects': [],
+    'sites': [],
+    'start_date': '',
+    'end_date': '',
+    'type': [],
+    'search': '',
+    'authors': [],
+    'hide_projects': False,
+}
+
+# a year, for responses that never change
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+STREAM_BATCH_SIZE = 1000
+STREAM_CHUNK_SIZE = 64 * 1024
+
 def basic_auth(method):
     @wraps(method)
     async def wrapper(self, *args, **kwargs):
@@ -39,19 +86,82 @@ def basic_auth(method):
         return await method(self, *args, **kwargs)
     return wrapper
 
-def get_domain(link):
-    """Get domain name of a url"""
-    if (not link.startswith('http')) and not link.startswith('//'):
-        link = f'//{link}'
-    return urlparse(link).netloc
+def filters_to_match_query(filters):
+    """Convert publication filters into a mongo match query"""
+    match = {}
+
+    if projects := filters.get('projects'):
+        match['projects'] = {"$all": projects}
+
+    if sites := filters.get('sites'):
+        match['sites'] = {"$all": sites}
+
+    if start := filters.get('start_date', ''):
+        match['datetime'] = {"$gte": parse_date(start)}
+    if end := filters.get('end_date', ''):
+        match.setdefault('datetime', {})["$lte"] = parse_date(end)
+
+    if types := filters.get('type'):
+        match['type'] = {"$in": types}
+
+    if search := filters.get('search', ''):
+        match['$text'] = {"$search": search}
+
+    if authors := filters.get('authors'):
+        match['authors'] = {"$all": authors}
+
+    return match
+
+def csv_formatter(fieldnames=FIELDS):
+    """
+    Make a function to format publications as csv rows.
+
+    Returns:
+        tuple: (header row, format function)
+    """
+    f = StringIO()
+    writer = csv.DictWriter(f, fieldnames=fieldnames)
+    writer.writeheader()
+    header = f.getvalue()
+
+    def format_row(p):
+        data = {}
+        for k in fieldnames:
+            if k not in p:
+                data[k] = ''
+            elif isinstance(p[k], list):
+                data[k] = ','.join(p[k])
+            else:
+                data[k] = p[k]
+        f.seek(0)
+        f.truncate()
+        writer.writerow(data)
+        return f.getvalue()
+
+    return header, format_row
 
 class BaseHandler(RequestHandler):
-    def initialize(self, db=None, basic_auth=None, debug=False, **kwargs):
+    # requests currently being handled in this process
+    in_flight = 0
+
+    def initialize(self, db=None, cache=None, fragments=None, metrics=None, basic_auth=None, debug=False, **kwargs):
         super().initialize(**kwargs)
+        BaseHandler.in_flight += 1
+        self.metrics = metrics
+        self.revision = None
+        if metrics:
+            metrics.request_started(self.__class__.__name__)
         self.db = db
+        self.cache = cache if cache is not None else QueryCache(maxsize=0)
+        self.fragments = fragments if fragments is not None else FragmentCache(maxbytes=0)
         self.basic_auth = basic_auth if basic_auth else {}
         self.debug = debug
 
+    def on_finish(self):
+        BaseHandler.in_flight -= 1
+        if self.metrics:
+            self.metrics.request_finished(self.__class__.__name__, self.get_status(), self.request.request_time())
+
     def set_default_headers(self):
         self._headers['Server'] = f'Pub DB {version}'
 
@@ -66,6 +176,7 @@ class BaseHandler(RequestHandler):
         namespace['SITES'] = SITES
         namespace['error'] = None
         namespace['edit'] = False
+        namespace['embed'] = False
         return namespace
 
     def get_current_user(self):
@@ -84,131 +195,376 @@ class BaseHandler(RequestHandler):
             logger.info('failed auth', exc_info=True)
         return None
 
-    def args_to_match_query(self):
-        match = {}
-
-        if projects := self.get_arguments('projects'):
-            match['projects'] = {"$all": projects}
-
-        if sites := self.get_arguments('sites'):
-            match['sites'] = {"$all": sites}
-
-        start = self.get_argument('start_date', '')
-        end = self.get_argument('end_date', '')
-        if start and end:
-            match['date'] = {"$gte": start, "$lte": end}
-        elif start:
-            match['date'] = {"$gte": start}
-        elif end:
-            match['date'] = {"$lte": end}
-
-        if types := self.get_arguments('type'):
-            match['type'] = {"$in": types}
-
-        if search := self.get_argument('search', ''):
-            match['$text'] = {"$search": search}
-
-        if authors := self.get_arguments('authors'):
-            match['authors'] = {"$all": authors}
-
-        return match, {
-            'projects': projects,
-            'sites': sites,
-            'start_date': start,
-            'end_date': end,
-            'type': types,
-            'search': search,
-            'authors': authors,
-        }
+    async def not_modified(self):
+        """
+        Set ETag and Last-Modified headers from the collection revision.
+
+        Returns:
+            bool: True if the client copy is current, and a 304 is set
+        """
+        revision, modified = await get_revision(self.db)
+        self.revision = revision
+        args = {k: [v.decode('utf-8', 'replace') for v in vals] for k, vals in self.request.query_arguments.items()}
+        key = make_key(self.__class__.__name__, version, revision, args, self.request.headers.get('Accept', ''))
+        self.set_header('Etag', '"' + hashlib.sha1(key.encode('utf-8')).hexdigest() + '"')
+        if modified:
+            self.set_header('Last-Modified', modified)
+        if self.check_etag_header():
+            self.set_status(304)
+            return True
+        return False
+
+    async def load_revision(self):
+        """
+        Get the collection revision, loading it once per request.
+
+        Cached query results are keyed on it, so other processes never
+        serve results from before a write.
+        """
+        if self.revision is None:
+            self.revision, _ = await get_revision(self.db)
+        return self.revision
+
+    def args_to_match_query(self, query=None):
+        """
+        Get the match query for the request arguments.
+
+        Args:
+            query (dict): filters to use instead of the request arguments
+        """
+        if query is None:
+            filters = {
+                'projects': self.get_arguments('projects'),
+                'sites': self.get_arguments('sites'),
+                'start_date': self.get_argument('start_date', ''),
+                'end_date': self.get_argument('end_date', ''),
+                'type': self.get_arguments('type'),
+                'search': self.get_argument('search', ''),
+                'authors': self.get_arguments('authors'),
+            }
+        else:
+            filters = {}
+            for k in ('projects', 'sites', 'start_date', 'end_date', 'type', 'search', 'authors'):
+                v = query.get(k, FILTER_DEFAULTS[k])
+                if isinstance(FILTER_DEFAULTS[k], list):
+                    v = [v] if isinstance(v, str) else v
+                    if not (isinstance(v, list) and all(isinstance(x, str) for x in v)):
+                        raise HTTPError(400, reason=f'invalid {k}')
+                elif not isinstance(v, str):
+                    raise HTTPError(400, reason=f'invalid {k}')
+                filters[k] = v
+        try:
+            return filters_to_match_query(filters), filters
+        except ValueError:
+            raise HTTPError(400, reason='invalid date')
+
+    def args_to_fields(self, values=None):
+        """Get the requested publication fields, in `FIELDS` order, or None for all"""
+        if values is None:
+            values = self.get_arguments('fields')
+        elif isinstance(values, str):
+            values = [values]
+        if not isinstance(values, list) or not all(isinstance(v, str) for v in values):
+            raise HTTPError(400, reason='invalid fields')
+        fields = {f.strip() for arg in values for f in arg.split(',') if f.strip()}
+        if not fields:
+            return None
+        if fields - set(FIELDS):
+            raise HTTPError(400, reason='invalid fields')
+        return [f for f in FIELDS if f in fields]
 
     async def count_pubs(self):
         match, _ = self.args_to_match_query()
-        return await self.db.publications.count_documents(match)
+        key = make_key('count', await self.load_revision(), match)
+        if (count := self.cache.get(key)) is not None:
+            return count
 
-    async def get_pubs(self, mongoid=False, sortby='date'):
-        match, args = self.args_to_match_query()
+        if not match:
+            count = await self.db.publications.estimated_document_count()
+        else:
+            count = await self.db.publications.count_documents(match)
+        self.cache.set(key, count)
+        return count
 
-        kwargs = {}
-        if not mongoid:
-            kwargs['projection'] = {'_id': False}
+    async def get_facets(self):
+        """Count publications per type, project, site, and year, under the current filter"""
+        match, _ = self.args_to_match_query()
+        key = make_key('facets', await self.load_revision(), match)
+        if (ret := self.cache.get(key)) is not None:
+            return ret
+
+        def group(field):
+            return [{'$group': {'_id': field, 'count': {'$sum': 1}}}]
+        aggregation = [
+            {'$match': match},
+            {'$facet': {
+                'count': [{'$count': 'count'}],
+                'type': group('$type'),
+                'projects': [{'$unwind': '$projects'}] + group('$projects'),
+                'sites': [{'$unwind': '$sites'}] + group('$sites'),
+                'year': group({'$year': '$datetime'}),
+            }},
+        ]
+        ret = {
+            'count': 0,
+            'type': {k: 0 for k in PUBLICATION_TYPES},
+            'projects': {k: 0 for k in PROJECTS},
+            'sites': {k: 0 for k in SITES},
+            'year': {},
+        }
+        async for row in self.db.publications.aggregate(aggregation):
+            if row['count']:
+                ret['count'] = row['count'][0]['count']
+            for facet in ('type', 'projects', 'sites', 'year'):
+                for r in row[facet]:
+                    if r['_id'] is not None:
+                        ret[facet][str(r['_id'])] = r['count']
+        ret['year'] = dict(sorted(ret['year'].items()))
+        self.cache.set(key, ret)
+        return ret
 
-        if page := self.get_argument('page', None):
-            page = int(page)
-        if limit := self.get_argument('limit', None):
-            limit = int(limit)
+    def args_to_paging(self, query=None):
+        """Get the page, limit, and after arguments"""
+        if query is None:
+            return {k: self.get_argument(k, None) for k in ('page', 'limit', 'after')}
+        return {k: query.get(k) for k in ('page', 'limit', 'after')}
 
-        pubs = []
-        i = -1
-        cursor = self.db.publications.find(match, **kwargs)
-        if sortby:
-            cursor = cursor.sort(sortby, pymongo.DESCENDING)
-        async for row in cursor:
-            i += 1
-            if mongoid:
-                row['_id'] = str(row['_id'])
-            if page is not None and limit and i < page*limit:
-                continue
+    def args_to_page_query(self, sortby='date', paging=None):
+        """Get the keyset match, sort, skip, and limit for the requested page"""
+        if paging is None:
+            paging = self.args_to_paging()
+        try:
+            if page := paging['page']:
+                page = int(page)
+            if limit := paging['limit']:
+                limit = int(limit)
+        except (TypeError, ValueError):
+            raise HTTPError(400, reason='invalid page or limit')
+
+        page_match = {}
+        if after := paging['after']:
+            if sortby != 'date':
+                raise HTTPError(400, reason='after token requires date sort')
+            try:
+                after_date, after_id = decode_after_token(after)
+            except Exception:
+                raise HTTPError(400, reason='invalid after token')
+            # publications without a datetime (not yet migrated, or with an
+            # unparseable date) sort after all the others
+            if after_date is None:
+                page_match['$or'] = [{'datetime': None, '_id': {'$lt': after_id}}]
+            else:
+                page_match['$or'] = [
+                    {'datetime': {'$lt': after_date}},
+                    {'datetime': after_date, '_id': {'$lt': after_id}},
+                    {'datetime': None},
+                ]
+            page = None
+
+        sort = None
+        if sortby == 'relevance':
+            sort = [('score', TEXT_SCORE), ('_id', pymongo.DESCENDING)]
+        elif sortby:
+            sort = [(SORT_FIELDS.get(sortby, sortby), pymongo.DESCENDING), ('_id', pymongo.DESCENDING)]
+        skip = page*limit if page and limit else 0
+        return page_match, sort, skip, limit
+
+    def find_pubs(self, match, page_query, projection=None, **kwargs):
+        page_match, sort, skip, limit = page_query
+        cursor = self.db.publications.find({**match, **page_match}, projection=projection or None, **kwargs)
+        if sort:
+            cursor = cursor.sort(sort)
+        if skip:
+            cursor = cursor.skip(skip)
+        if limit:
+            cursor = cursor.limit(limit)
+        return cursor
+
+    async def get_pubs(self, mongoid=False, sortby='date', with_count=False, display=False, fields=None, query=None):
+        """
+        Get a page of publications.
+
+        Args:
+            query (dict): filters and paging to use instead of the request arguments
+        """
+        match, args = self.args_to_match_query(query)
+        paging = self.args_to_paging(query)
+        if sortby == 'relevance' and '$text' not in match:
+            sortby = 'date'
+        if fields and '_id' in fields:
+            mongoid = True
+        page_match, sort, skip, limit = page_query = self.args_to_page_query(sortby, paging)
+
+        # only cache bounded pages, as unlimited results can be the whole corpus
+        key = None
+        if limit:
+            key = make_key('pubs', await self.load_revision(), match, sortby, mongoid, with_count, display, fields,
+                           *(None if paging[k] is None else str(paging[k]) for k in ('page', 'limit', 'after')))
+            if (ret := self.cache.get(key)) is not None:
+                args.update(ret)
+                return args
+
+        # keyset pagination needs the _id of the last row of each page
+        keyset = sortby == 'date' and bool(limit)
+
+        projection = {}
+        if not (mongoid or keyset):
+            projection['_id'] = False
+        if fields:
+            projection.update({f: True for f in fields})
+            if keyset:
+                projection['datetime'] = True
+        elif not display:
+            projection.update({f: False for f in INTERNAL_FIELDS if not (keyset and f == 'datetime')})
+
+        if with_count and match and limit:
+            # get the page and the total count in one pass over the filter.
+            # only for bounded pages, as $facet returns one 16MB document
+            pipeline = [{'$match': page_match}]
+            if sortby == 'relevance':
+                pipeline.append({'$sort': {'score': pymongo.DESCENDING, '_id': pymongo.DESCENDING}})
+            elif sort:
+                pipeline.append({'$sort': dict(sort)})
+            if skip:
+                pipeline.append({'$skip': skip})
+            if limit:
+                pipeline.append({'$limit': limit})
+            if projection:
+                pipeline.append({'$project': projection})
+            aggregation = [
+                {'$match': match},
+                {'$facet': {
+                    'publications': pipeline,
+                    'count': [{'$count': 'count'}],
+                }},
+            ]
+            if sortby == 'relevance':
+                aggregation.insert(1, {'$addFields': {'score': TEXT_SCORE}})
+                if fields:
+                    projection['score'] = True
+            pubs, count = [], 0
+            async for row in self.db.publications.aggregate(aggregation):
+                pubs = row['publications']
+                if row['count']:
+                    count = row['count'][0]['count']
+        else:
+            if sortby == 'relevance':
+                projection['score'] = TEXT_SCORE
+            cursor = self.find_pubs(match, page_query, projection)
+            if with_count:
+                if match:
+                    count_coro = self.db.publications.count_documents(match)
+                else:
+                    count_coro = self.db.publications.estimated_document_count()
+                pubs, count = await asyncio.gather(cursor.to_list(None), count_coro)
+            else:
+                pubs = await cursor.to_list(None)
+
+        for row in pubs:
             if 'projects' in row:
                 row['projects'].sort()
             if 'sites' in row:
                 row['sites'].sort()
-            pubs.append(row)
-            if page is not None and limit and len(pubs) >= limit:
-                break
 
-        args['publications'] = pubs
+        ret = {}
+        if keyset:
+            ret['after'] = None
+            if len(pubs) >= limit:
+                ret['after'] = encode_after_token(pubs[-1].get('datetime'), pubs[-1]['_id'])
+        for row in pubs:
+            if mongoid:
+                row['_id'] = str(row['_id'])
+            else:
+                row.pop('_id', None)
+            if not display:
+                row.pop('datetime', None)
+
+        if with_count:
+            ret['count'] = count
+        ret['publications'] = pubs
+        if key:
+            self.cache.set(key, ret)
+
+        args.update(ret)
         return args
 
-    async def get_authors(self):
-        aggregation = [
-            {"$unwind": "$authors"},
-            {"$group": {
-                "_id": 0,
-                "authornames": {"$addToSet": "$authors"}
-            }}
-        ]
-        authors = []
-        async for row in self.db.publications.aggregate(aggregation):
-            authors = row["authornames"]
-        return authors
+    def render_pubs(self, pubs, **kwargs):
+        """Render publication articles, reusing cached fragments"""
+        variant = make_key(kwargs)
+        articles = []
+        for pub in pubs:
+            rev = pub.get('rev')
+            html = self.fragments.get(pub['_id'], rev, variant) if rev else None
+            if html is None:
+                html = self.render_string('publication.html', pub=pub, **kwargs).decode('utf-8')
+                if rev:
+                    self.fragments.set(pub['_id'], rev, html, variant)
+            articles.append(html)
+        return articles
+
+    async def stream_pubs(self, format_row, sortby='date', fields=None):
+        """Stream formatted publications from the cursor, flushing in chunks"""
+        match, _ = self.args_to_match_query()
+        if sortby == 'relevance' and '$text' not in match:
+            sortby = 'date'
+        page_query = self.args_to_page_query(sortby)
+        if fields:
+            projection = {'_id': '_id' in fields, **{f: True for f in fields}}
+        else:
+            projection = {'_id': False, **{f: False for f in INTERNAL_FIELDS}}
+        if sortby == 'relevance':
+            projection['score'] = TEXT_SCORE
+        cursor = self.find_pubs(match, page_query, projection, batch_size=STREAM_BATCH_SIZE)
+
+        buf, size = [], 0
+        async for row in cursor:
+            if '_id' in row:
+                row['_id'] = str(row['_id'])
+            if 'projects' in row:
+                row['projects'].sort()
+            if 'sites' in row:
+                row['sites'].sort()
+            data = format_row(row)
+            buf.append(data)
+            size += len(data)
+            if size >= STREAM_CHUNK_SIZE:
+                self.write(''.join(buf))
+                buf, size = [], 0
+                await self.flush()
+        self.write(''.join(buf))
 
 class Main(BaseHandler):
     async def get(self):
+        if await self.not_modified():
+            return
         hide_projects = self.get_argument('hide_projects', 'false').lower() == 'true'
 
-        pubs = await self.get_pubs()
+        pubs = await self.get_pubs(mongoid=True, display=True)
+        articles = self.render_pubs(pubs['publications'], hide_projects=hide_projects)
 
-        self.render('main.html', **pubs, hide_projects=hide_projects)
+        self.render('main.html', **pubs, articles=articles, hide_projects=hide_projects)
 
 class CSV(BaseHandler):
     async def get(self):
+        if await self.not_modified():
+            return
         sortby = self.get_argument('sort', 'date')
-        pubs = await self.get_pubs(sortby=sortby)
-
-        f = StringIO()
-        writer = csv.DictWriter(f, fieldnames=FIELDS)
-        writer.writeheader()
-        for p in pubs['publications']:
-            data = {}
-            for k in FIELDS:
-                if k not in p:
-                    data[k] = ''
-                elif isinstance(p[k], list):
-                    data[k] = ','.join(p[k])
-                else:
-                    data[k] = p[k]
-            writer.writerow(data)
+        fields = self.args_to_fields()
 
-        self.write(f.getvalue())
+        header, format_row = csv_formatter(fields or FIELDS)
         self.set_header('Content-Type', 'text/csv; charset=utf-8')
+        self.write(header)
+        await self.stream_pubs(format_row, sortby=sortby, fields=fields)
 
 class Manage(BaseHandler):
+    async def render_manage(self, message=''):
+        pubs = await self.get_pubs(mongoid=True, display=True)
+        self.render('manage.html', message=message, **pubs)
+
     @catch_error
     @basic_auth
     async def get(self):
-        existing_authors = await self.get_authors()
-        pubs = await self.get_pubs(mongoid=True)
-        self.render('manage.html', message='', existing_authors=existing_authors, **pubs)
+        await self.render_manage()
 
     @catch_error
     @basic_auth
@@ -218,7 +574,7 @@ class Manage(BaseHandler):
             if action := self.get_argument('action', None):
                 if action == 'delete':
                     mongoid = ObjectId(self.get_argument('pub_id'))
-                    await self.db.publications.delete_one({'_id': mongoid})
+                    await delete_pub(db=self.db, mongo_id=mongoid)
                 elif action == 'new':
                     doc = {
                         'title': self.get_argument('new_title').strip(),
@@ -249,18 +605,85 @@ class Manage(BaseHandler):
                 elif action == 'import':
                     if not self.request.files:
                         raise Exception('no files uploaded')
+                    summary = {'inserted': 0, 'updated': 0, 'unchanged': 0}
                     for files in itertools.chain(self.request.files.values()):
                         for f in files:
-                            await try_import_file(self.db, f.body.decode('utf-8-sig'))
+                            ret = await try_import_file(self.db, f.body.decode('utf-8-sig'))
+                            for k in summary:
+                                summary[k] += ret[k]
+                    message = 'Imported {inserted} new, {updated} updated, {unchanged} unchanged publications'.format(**summary)
                 else:
                     raise Exception('bad action')
         except Exception as e:
             if self.debug:
                 logging.debug('manage error', exc_info=True)
             message = f'Error: {e}'
-        existing_authors = await self.get_authors()
-        pubs = await self.get_pubs(mongoid=True)
-        self.render('manage.html', message=message, existing_authors=existing_authors, **pubs)
+        await self.render_manage(message)
+
+@stream_request_body
+class ManageImport(Manage):
+    """
+    Import publications from an upload as it streams in.
+
+    Accepts a multipart form upload, or a raw csv or json body.
+    """
+    SUPPORTED_METHODS = ('POST',)
+
+    def initialize(self, max_size=None, **kwargs):
+        super().initialize(**kwargs)
+        self.max_size = max_size
+
+    @basic_auth
+    async def prepare(self):
+        if self.max_size:
+            self.request.connection.set_max_body_size(self.max_size)
+        self.importer = StreamImporter(self.db)
+        self.error = None
+        self.parser = None
+        content_type = self.request.headers.get('Content-Type', '')
+        if content_type.startswith('multipart/form-data'):
+            for field in content_type.split(';'):
+                k, _, v = field.strip().partition('=')
+                if k == 'boundary' and v:
+                    boundary = v.strip('"').encode('latin1')
+                    self.parser = MultipartParser(boundary, self.importer.feed, self.importer.end_file)
+                    break
+            else:
+                raise HTTPError(400, reason='invalid multipart form data')
+
+    async def data_received(self, chunk):
+        if self.error:
+            return
+        try:
+            if self.parser:
+                await self.parser.feed(chunk)
+            else:
+                await self.importer.feed(chunk)
+        except Exception as e:
+            self.error = e
+
+    @catch_error
+    async def post(self):
+        try:
+            if not self.error:
+                if self.parser:
+                    self.parser.close()
+                else:
+                    await self.importer.end_file()
+                if not self.importer.files:
+                    raise Exception('no files uploaded')
+                await self.importer.flush()
+        except Exception as e:
+            self.error = e
+        finally:
+            await bump_revision(self.db)
+
+        message = 'Imported {inserted} new, {updated} updated, {unchanged} unchanged publications'.format(**self.importer.summary)
+        if self.error:
+            if self.debug:
+                logging.debug('import error', exc_info=self.error)
+            message = f'Error: {self.error}. {message}'
+        await self.render_manage(message)
 
 class APIBaseHandler(BaseHandler):
     def write_error(self, status_code=500, **kwargs):
@@ -275,29 +698,258 @@ class APIBaseHandler(BaseHandler):
 class APIPubs(APIBaseHandler):
     @catch_error
     async def get(self):
-        pubs = await self.get_pubs()
+        # json or ndjson, by the Accept header, so shared caches must key on it
+        self.set_header('Vary', 'Accept')
+        if await self.not_modified():
+            return
+        sortby = self.get_argument('sort', 'date')
+        if sortby not in API_SORTS:
+            raise HTTPError(400, reason='invalid sort')
+        fields = self.args_to_fields()
+        if (self.get_argument('format', '') == 'ndjson'
+                or 'application/x-ndjson' in self.request.headers.get('Accept', '')):
+            self.set_header('Content-Type', 'application/x-ndjson')
+            await self.stream_pubs(lambda row: json.dumps(row) + '\n', sortby=sortby, fields=fields)
+            return
+
+        with_count = self.get_argument('with_count', 'false').lower() == 'true'
+        pubs = await self.get_pubs(sortby=sortby, with_count=with_count, fields=fields)
         self.write(pubs)
 
+class APIPubsBatch(APIBaseHandler):
+    """
+    Run several publication queries concurrently, in one request.
+
+    The body is a json list of queries (or an object with a `queries`
+    list). Each query has the filters of `/api/publications`, and optional
+    `page`, `limit`, `after`, `sort`, `fields`, and `with_count` (default
+    true) arguments.
+    """
+    def check_xsrf_cookie(self):
+        # read-only, so there is nothing to forge
+        pass
+
+    @catch_error
+    async def post(self):
+        try:
+            queries = json.loads(self.request.body)
+        except ValueError:
+            raise HTTPError(400, reason='invalid json')
+        if isinstance(queries, dict):
+            queries = queries.get('queries')
+        if not isinstance(queries, list) or not all(isinstance(q, dict) for q in queries):
+            raise HTTPError(400, reason='expected a list of queries')
+        if len(queries) > BATCH_MAX_QUERIES:
+            raise HTTPError(400, reason=f'too many queries, max is {BATCH_MAX_QUERIES}')
+
+        # validate everything before starting any queries
+        kwargs = []
+        for query in queries:
+            sortby = query.get('sort', 'date')
+            if sortby not in API_SORTS:
+                raise HTTPError(400, reason='invalid sort')
+            with_count = query.get('with_count', True)
+            if isinstance(with_count, str):
+                with_count = with_count.lower() == 'true'
+            kwargs.append({
+                'sortby': sortby,
+                'with_count': bool(with_count),
+                'fields': self.args_to_fields(query.get('fields', [])),
+                'query': query,
+            })
+            self.args_to_match_query(query)
+            self.args_to_page_query(sortby, self.args_to_paging(query))
+
+        await self.load_revision()
+        results = await asyncio.gather(*[self.get_pubs(**k) for k in kwargs])
+        self.write({'results': results})
+
+class APIPubsHTML(APIBaseHandler):
+    """
+    Rendered publication articles, for embedding without javascript.
+
+    Abstracts use `<details>` instead of a script-driven button.
+    """
+    @catch_error
+    async def get(self):
+        if await self.not_modified():
+            return
+        hide_projects = self.get_argument('hide_projects', 'false').lower() == 'true'
+
+        pubs = await self.get_pubs(mongoid=True, display=True)
+        articles = self.render_pubs(pubs['publications'], hide_projects=hide_projects, embed=True)
+
+        self.set_header('Content-Type', 'text/html; charset=UTF-8')
+        self.write('\n'.join(articles))
+
 class APIPubsCount(APIBaseHandler):
     @catch_error
     async def get(self):
+        if await self.not_modified():
+            return
         pubs = await self.count_pubs()
         self.write({"count": pubs})
 
-class APIFilterDefaults(APIBaseHandler):
+class APIPubsFacets(APIBaseHandler):
+    @catch_error
+    async def get(self):
+        if await self.not_modified():
+            return
+        facets = await self.get_facets()
+        self.write(facets)
+
+class APIAuthorsSuggest(APIBaseHandler):
+    """Suggest author names starting with a prefix"""
+    def initialize(self, author_index=None, **kwargs):
+        super().initialize(**kwargs)
+        self.author_index = author_index if author_index is not None else AuthorIndex()
+
+    @catch_error
+    async def get(self):
+        if await self.not_modified():
+            return
+        prefix = self.get_argument('prefix', '')
+        try:
+            limit = min(int(self.get_argument('limit', 20)), 100)
+        except ValueError:
+            raise HTTPError(400, reason='invalid limit')
+        await self.author_index.refresh(self.db, self.revision)
+        self.write({'authors': self.author_index.suggest(prefix, limit=limit)})
+
+class APIBootstrap(APIBaseHandler):
+    """
+    Everything an embed widget needs to start, in one response.
+
+    Includes the filter defaults, types, projects, and the first page of
+    publications for the given filters. The `version` in the response
+    changes with any write, so a request that passes back the current
+    version as `v` can be cached forever.
+    """
     @catch_error
     async def get(self):
+        if await self.not_modified():
+            self.set_cache_headers()
+            return
+        pubs = await self.get_pubs(with_count=True, fields=self.args_to_fields())
+        self.set_cache_headers()
         self.write({
-            'projects': [],
-            'sites': [],
-            'start_date': '',
-            'end_date': '',
-            'type': [],
-            'search': '',
-            'authors': [],
-            'hide_projects': False,
+            'version': self.data_version(),
+            'filter_defaults': FILTER_DEFAULTS,
+            'types': PUBLICATION_TYPES,
+            'projects': PROJECTS,
+            'count': pubs['count'],
+            'publications': pubs['publications'],
         })
 
+    def data_version(self):
+        return f'{version}.{self.revision}'
+
+    def set_cache_headers(self):
+        if self.get_argument('v', None) == self.data_version():
+            self.set_header('Cache-Control', f'public, max-age={IMMUTABLE_MAX_AGE}, immutable')
+        else:
+            self.set_header('Cache-Control', 'public, no-cache')
+
+class Ready(APIBaseHandler):
+    """Readiness check, with the progress of any index builds"""
+    def initialize(self, index_status=None, **kwargs):
+        super().initialize(**kwargs)
+        self.index_status = index_status if index_status is not None else {}
+
+    async def get_index_progress(self):
+        aggregation = [
+            {'$currentOp': {'allUsers': True}},
+            {'$match': {'ns': f'{self.db.name}.publications', 'progress': {'$exists': True}}},
+        ]
+        progress = []
+        try:
+            async for row in self.db.client.admin.aggregate(aggregation):
+                progress.append({k: row['progress'].get(k) for k in ('done', 'total')} | {'msg': row.get('msg', '')})
+        except Exception:
+            logger.debug('cannot get index build progress', exc_info=True)
+        return progress
+
+    async def get(self):
+        try:
+            await self.db.command('ping')
+        except Exception:
+            logger.warning('database is not reachable', exc_info=True)
+            self.set_status(503)
+            self.write({'ready': False, 'error': 'database is not reachable'})
+            return
+
+        existing = await self.db.publications.index_information()
+        indexes = {
+            'ready': [name for name in INDEXES if name in existing],
+            'pending': [name for name in INDEXES if name not in existing],
+            'error': self.index_status.get('error'),
+        }
+        if indexes['pending']:
+            indexes['progress'] = await self.get_index_progress()
+        self.write({'ready': True, 'indexes': indexes})
+
+class MetricsHandler(BaseHandler):
+    """Metrics for this process, in Prometheus text format"""
+    async def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(self.metrics.render() if self.metrics else '')
+
+class APIChanges(APIBaseHandler):
+    """
+    Server-sent events for publication changes.
+
+    Events are `insert`, `update`, or `delete`, optionally filtered by
+    `projects`, `sites`, and `type`.
+    """
+    def initialize(self, changes=None, **kwargs):
+        super().initialize(**kwargs)
+        self.changes = changes
+        self.queue = None
+
+    def on_connection_close(self):
+        if self.queue is not None:
+            self.changes.close_subscriber(self.queue)
+
+    @catch_error
+    async def get(self):
+        if self.changes is not None:
+            try:
+                await asyncio.wait_for(self.changes.started.wait(), timeout=SSE_KEEPALIVE)
+            except asyncio.TimeoutError:
+                pass
+        if self.changes is None or not self.changes.available:
+            raise HTTPError(503, reason='live changes are not available')
+        filters = {
+            'projects': self.get_arguments('projects'),
+            'sites': self.get_arguments('sites'),
+            'type': self.get_arguments('type'),
+        }
+        self.set_header('Content-Type', 'text/event-stream')
+        self.set_header('Cache-Control', 'no-cache')
+        self.set_header('X-Accel-Buffering', 'no')  # for nginx
+
+        with self.changes.subscribe(filters) as self.queue:
+            self.write(': connected\n\n')
+            while True:
+                try:
+                    await self.flush()
+                except StreamClosedError:
+                    break
+                try:
+                    event = await asyncio.wait_for(self.queue.get(), timeout=SSE_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    self.write(': keepalive\n\n')
+                    continue
+                if event is None:
+                    break
+                self.write(f'event: {event["type"]}\ndata: {json.dumps(event)}\n\n')
+        self.queue = None
+
+class APIFilterDefaults(APIBaseHandler):
+    @catch_error
+    async def get(self):
+        self.write(FILTER_DEFAULTS)
+
 class APITypes(APIBaseHandler):
     @catch_error
     async def get(self):
@@ -308,7 +960,43 @@ class APIProjects(APIBaseHandler):
     async def get(self):
         self.write(PROJECTS)
 
-def create_server():
+class Server(RestServer):
+    """A RestServer that can share its port, and shuts down gracefully"""
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # called at shutdown, to end long-lived requests
+        self.on_stop = []
+
+    def startup(self, address='localhost', port=8080, reuse_port=False):
+        if not reuse_port:
+            return super().startup(address=address, port=port)
+        logger.warning('tornado bound to %s:%d with SO_REUSEPORT', address, port)
+        app = Application(self.routes, **self.app_args)
+        if self.http_server:
+            self.http_server.stop()
+        self.http_server = HTTPServer(app, xheaders=True, max_body_size=self.max_body_size)
+        self.http_server.bind(port, address=address, family=socket.AF_INET, reuse_port=True)
+        self.http_server.start()
+
+    async def stop(self, timeout=0):
+        """Stop accepting connections, and wait up to `timeout` seconds for requests in flight"""
+        if self.http_server:
+            self.http_server.stop()
+            for callback in self.on_stop:
+                callback()
+            end = time.monotonic() + timeout
+            while BaseHandler.in_flight > 0 and time.monotonic() < end:
+                await asyncio.sleep(.1)
+        await super().stop()
+
+def create_server(reuse_port=False, run_startup=True):
+    """
+    Create and start the server.
+
+    Args:
+        reuse_port (bool): share the port with other server processes
+        run_startup (bool): run the startup migration and index build
+    """
     static_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
     template_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
 
@@ -319,14 +1007,52 @@ def create_server():
         'DB_URL': 'mongodb://localhost/pub_db',
         'COOKIE_SECRET': binascii.hexlify(b'secret').decode('utf-8'),
         'BASIC_AUTH': '',  # user:pass,user:pass
+        'CACHE_SIZE': 256,  # max cached query results, 0 to disable
+        'CACHE_TTL': 60,  # seconds
+        'CACHE_MAX_BYTES': 64*1024*1024,  # approximate bytes of cached results, 0 for no limit
+        'FRAGMENT_CACHE_SIZE': 32*1024*1024,  # bytes of rendered html, 0 to disable
+        'IMPORT_MAX_SIZE': 1024**3,  # bytes
     }
     config = from_environment(default_config)
 
     logging.info(f'DB: {config["DB_URL"]}')
     db_url, db_name = config['DB_URL'].rsplit('/', 1)
     logging.info(f'DB name: {db_name}')
-    db = motor.motor_asyncio.AsyncIOMotorClient(db_url)
-    create_indexes(db_url, db_name)
+
+    cache = QueryCache(maxsize=config['CACHE_SIZE'], ttl=config['CACHE_TTL'], maxbytes=config['CACHE_MAX_BYTES'])
+    logging.info(f'Query cache: size {config["CACHE_SIZE"]}, ttl {config["CACHE_TTL"]}s, max bytes {config["CACHE_MAX_BYTES"]}')
+
+    fragments = FragmentCache(maxbytes=config['FRAGMENT_CACHE_SIZE'])
+
+    metrics = Metrics(caches={'query': cache, 'fragment': fragments})
+    db = motor.motor_asyncio.AsyncIOMotorClient(db_url, event_listeners=[metrics.command_timer])
+
+    # build indexes after startup, without blocking requests
+    index_status = {'ready': [], 'pending': list(INDEXES), 'error': None}
+
+    async def startup():
+        try:
+            await migrate_display_fields(db[db_name])
+        except Exception:
+            logging.error('failed to migrate display fields', exc_info=True)
+        try:
+            await migrate_authors(db[db_name])
+        except Exception:
+            logging.error('failed to build the author registry', exc_info=True)
+        try:
+            await create_indexes(db[db_name], status=index_status)
+            logging.info('indexes are ready')
+        except Exception as e:
+            logging.error('failed to create indexes', exc_info=True)
+            index_status['error'] = str(e)
+    if run_startup:
+        IOLoop.current().spawn_callback(startup)
+
+    # every process tails changes, to invalidate its own caches. this uses
+    # its own client, so the long-polling getMores stay out of the metrics
+    changes_client = motor.motor_asyncio.AsyncIOMotorClient(db_url)
+    changes = ChangeFeed(changes_client[db_name])
+    changes.start()
 
     users = {v.split(':')[0]: v.split(':')[1] for v in config['BASIC_AUTH'].split(',') if v}
     logging.info(f'BASIC_AUTH users: {list(users.keys())}')
@@ -334,22 +1060,36 @@ def create_server():
     main_args = {
         'debug': config['DEBUG'],
         'db': db[db_name],
+        'cache': cache,
+        'fragments': fragments,
+        'metrics': metrics,
         'basic_auth': users,
     }
 
-    server = RestServer(static_path=static_path, template_path=template_path,
-                        cookie_secret=config['COOKIE_SECRET'], xsrf_cookies=True,
-                        debug=config['DEBUG'])
+    server = Server(static_path=static_path, template_path=template_path,
+                    cookie_secret=config['COOKIE_SECRET'], xsrf_cookies=True,
+                    debug=config['DEBUG'])
 
     server.add_route(r'/', Main, main_args)
     server.add_route(r'/csv', CSV, main_args)
-    server.add_route(r'/manage', Manage, main_args)
+    server.add_route(r'/manage', Manage, main_args, 'manage')
+    server.add_route(r'/manage/import', ManageImport, {**main_args, 'max_size': config['IMPORT_MAX_SIZE']}, 'manage_import')
     server.add_route(r'/api/publications', APIPubs, main_args)
     server.add_route(r'/api/publications/count', APIPubsCount, main_args)
+    server.add_route(r'/api/publications/batch', APIPubsBatch, main_args)
+    server.add_route(r'/api/publications/html', APIPubsHTML, main_args)
+    server.add_route(r'/api/publications/facets', APIPubsFacets, main_args)
+    server.add_route(r'/api/authors/suggest', APIAuthorsSuggest, {**main_args, 'author_index': AuthorIndex()}, 'authors_suggest')
+    server.add_route(r'/ready', Ready, {**main_args, 'index_status': index_status})
+    server.add_route(r'/metrics', MetricsHandler, main_args)
+    server.add_route(r'/api/bootstrap', APIBootstrap, main_args)
+    server.add_route(r'/api/changes', APIChanges, {**main_args, 'changes': changes})
     server.add_route(r'/api/filter_defaults', APIFilterDefaults, main_args)
     server.add_route(r'/api/types', APITypes, main_args)
     server.add_route(r'/api/projects', APIProjects, main_args)
 
-    server.startup(address=config['HOST'], port=config['PORT'])
+    server.on_stop.append(changes.stop)
+    server.on_stop.append(changes_client.close)
+    server.startup(address=config['HOST'], port=config['PORT'], reuse_port=reuse_port)
 
     return server
@@ -95,58 +95,62 @@ let URLSerializer = function(p){
 };
 
 async function Pubs(id, baseurl = 'https://publications.icecube.aq', filters = {}, show_dates = false) {
+  // the data version from the last visit, so a repeat visit can come
+  // straight from the browser cache
+  const version_key = 'pubs_version:'+baseurl;
+  let cached_version = null;
+  try {
+    cached_version = window.localStorage.getItem(version_key);
+  } catch (e) {
+    console.log('localStorage is not available');
+  }
+  var saveVersion = function(v) {
+    try {
+      window.localStorage.setItem(version_key, v);
+    } catch (e) { }
+  };
+
+  // get everything needed to start in one request, while loading dependencies
+  let bootstrap_filters = Object.assign({}, filters);
+  bootstrap_filters['page'] = 0
+  bootstrap_filters['limit'] = 20
+  var getBootstrap = function(params) {
+    return fetch(baseurl+'/api/bootstrap?'+URLSerializer(params)).then(function(response){
+      if (!response.ok) {
+        throw new Error('bootstrap failed: '+response.status);
+      }
+      return response.json();
+    });
+  };
+  const bootstrap_fut = getBootstrap(cached_version ? Object.assign({v: cached_version}, bootstrap_filters) : bootstrap_filters);
   await loadDeps(baseurl);
 
   var updatePubs = async function(filters) {
     console.log('getting pubs for filters:')
     console.log(filters)
+    let params = Object.assign({with_count: true}, filters);
     const response = await axios.get(baseurl+'/api/publications', {
-      params: filters,
+      params: params,
       paramsSerializer: URLSerializer
     });
     console.log('pubs resp:')
     console.log(response.data)
-    return response.data['publications'];
-  };
-
-  var updatePubsCount = async function(filters) {
-    const response = await axios.get(baseurl+'/api/publications/count', {
-      params: filters,
-      paramsSerializer: URLSerializer
-    });
-    return response.data['count'];
+    return response.data;
   };
 
-  // get data from server in parallel
-  let filter_defaults_fut = axios.get(baseurl+'/api/filter_defaults');
-  let publication_types_fut = (async function(){
-    const response = await axios.get(baseurl+'/api/types');
-    console.log('publication_types:')
-    console.log(response.data)
-    return response.data;
-  })();
-  let projects_fut = (async function(){
-    const response = await axios.get(baseurl+'/api/projects');
-    console.log('projects:')
-    console.log(response.data)
-    return response.data;
-  })();
-  let pubs_count_fut = updatePubsCount(filters);
-  let pubs_filters = Object.assign({}, filters);
-  pubs_filters['page'] = 0
-  pubs_filters['limit'] = 20
-  let pubs_fut = updatePubs(pubs_filters);
+  const bootstrap = await bootstrap_fut;
+  console.log('bootstrap:')
+  console.log(bootstrap)
 
   // merge default filters
-  const response = await filter_defaults_fut;
-  var filters_with_defaults = response.data;
+  var filters_with_defaults = Object.assign({}, bootstrap['filter_defaults']);
   Object.assign(filters_with_defaults, filters);
 
   // get publications
-  let publication_types = await publication_types_fut;
-  let projects = await projects_fut;
-  let pubs = await pubs_fut;
-  let pubsCount = await pubs_count_fut;
+  let publication_types = bootstrap['types'];
+  let projects = bootstrap['projects'];
+  let pubs = bootstrap['publications'];
+  let pubsCount = bootstrap['count'];
 
   Vue.component('pub', {
     data: function() {
@@ -338,12 +342,26 @@ async function Pubs(id, baseurl = 'https://publications.icecube.aq', filters = {
         let params = JSON.parse(JSON.stringify( this.filters ));
         params['page'] = this.page-1
         params['limit'] = this.limit
-        const count_fut = updatePubsCount(params)
-        const pubs_fut = updatePubs(params);
-        this.count = await count_fut;
-        this.pubs = await pubs_fut;
+        const data = await updatePubs(params);
+        this.count = data['count'];
+        this.pubs = data['publications'];
         this.typing = '';
       }
     }
   });
+
+  if (cached_version) {
+    // the cached copy may be out of date, so check the current version
+    // (a cheap revalidation if nothing changed)
+    getBootstrap(bootstrap_filters).then(function(latest){
+      saveVersion(latest['version']);
+      if (latest['version'] != bootstrap['version']) {
+        app.update();
+      }
+    }).catch(function(e){
+      console.log('version check failed: '+e);
+    });
+  } else {
+    saveVersion(bootstrap['version']);
+  }
 }
@@ -1,41 +1,218 @@
+from collections import Counter
 from datetime import datetime
 import logging
 import json
 import csv
+import base64
+import binascii
+import hashlib
 from io import StringIO
+from urllib.parse import urlparse
 
 import pymongo
+from bson.errors import InvalidId
 from bson.objectid import ObjectId
 
-from . import PUBLICATION_TYPES, PROJECTS, SITES
+from . import PUBLICATION_TYPES, PROJECTS, SITES, FIELDS
+from .cache import invalidate_all, invalidate_fragments
+
+IMPORT_BATCH_SIZE = 1000
 
 def nowstr():
     return datetime.utcnow().isoformat()
 
-def date_format(datestring):
+def parse_date(datestring):
     if 'T' in datestring:
         if '.' in datestring:
-            date = datetime.strptime(datestring, "%Y-%m-%dT%H:%M:%S.%f")
+            return datetime.strptime(datestring, "%Y-%m-%dT%H:%M:%S.%f")
         else:
-            date = datetime.strptime(datestring, "%Y-%m-%dT%H:%M:%S")
+            return datetime.strptime(datestring, "%Y-%m-%dT%H:%M:%S")
     else:
-        date = datetime.strptime(datestring, "%Y-%m-%d")
-    return date.strftime("%d %B %Y")
-
-def create_indexes(db_url, db_name, background=True):
-    db = pymongo.MongoClient(db_url)[db_name]
-    indexes = db.publications.index_information()
-    if 'projects_index' not in indexes:
-        logging.info('creating projects_index')
-        db.publications.create_index('projects', name='projects_index', background=background)
-    if 'date_index' not in indexes:
-        logging.info('creating date_index')
-        db.publications.create_index('date', name='date_index', background=background)
-    if 'text_index' not in indexes:
-        logging.info('creating text_index')
-        db.publications.create_index([('title', pymongo.TEXT), ('authors', pymongo.TEXT), ('citation', pymongo.TEXT)],
-                                     weights={'title': 10, 'authors': 5, 'citation': 1},
-                                     name='text_index', background=background)
+        return datetime.strptime(datestring, "%Y-%m-%d")
+
+def date_format(datestring):
+    return parse_date(datestring).strftime("%d %B %Y")
+
+def get_domain(link):
+    """Get domain name of a url"""
+    if (not link.startswith('http')) and not link.startswith('//'):
+        link = f'//{link}'
+    return urlparse(link).netloc
+
+def display_fields(date=None, downloads=None):
+    """Precompute the stored date and display fields of a publication"""
+    ret = {}
+    if date is not None:
+        ret['datetime'] = parse_date(date)
+        ret['date_display'] = ret['datetime'].strftime("%d %B %Y")
+    if downloads is not None:
+        ret['download_domains'] = [get_domain(d) for d in downloads]
+    return ret
+
+def content_rev(pub):
+    """Get a revision stamp for the content of a publication"""
+    data = {k: pub.get(k) for k in FIELDS if k != '_id'}
+    return hashlib.sha1(json.dumps(data, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:16]
+
+def encode_after_token(date, mongo_id):
+    """
+    Encode a (datetime, _id) keyset position as an opaque url-safe token.
+
+    The datetime is None for publications without a stored datetime.
+    """
+    data = json.dumps([date.isoformat() if date else None, str(mongo_id)], separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_after_token(token):
+    """Decode a token from `encode_after_token` back into (datetime, ObjectId)"""
+    try:
+        data = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        date, mongo_id = json.loads(data.decode('utf-8'))
+        if date is None:
+            return None, ObjectId(mongo_id)
+        assert isinstance(date, str)
+        return datetime.fromisoformat(date), ObjectId(mongo_id)
+    except (binascii.Error, ValueError, TypeError, AssertionError, InvalidId):
+        raise Exception('invalid after token')
+
+# indexes for each filter shape, ending in the default (datetime, _id) sort
+INDEXES = {
+    'datetime_id_index': {'keys': [('datetime', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)]},
+    'projects_datetime_index': {'keys': [('projects', pymongo.ASCENDING), ('datetime', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)]},
+    'sites_datetime_index': {'keys': [('sites', pymongo.ASCENDING), ('datetime', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)]},
+    'type_datetime_index': {'keys': [('type', pymongo.ASCENDING), ('datetime', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)]},
+    'authors_datetime_index': {'keys': [('authors', pymongo.ASCENDING), ('datetime', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)]},
+    'text_index': {
+        'keys': [('title', pymongo.TEXT), ('authors', pymongo.TEXT), ('citation', pymongo.TEXT)],
+        'weights': {'title': 10, 'authors': 5, 'citation': 1},
+    },
+}
+
+# indexes from older versions, that no query uses any more:
+# projects_index is a prefix of projects_datetime_index, and nothing
+# filters or sorts on the `date` string
+OBSOLETE_INDEXES = ['projects_index', 'date_index']
+
+async def create_indexes(db, background=True, status=None):
+    """
+    Create any missing indexes on the publications collection, and drop
+    obsolete ones.
+
+    Args:
+        db (AsyncIOMotorDatabase): database
+        background (bool): build indexes in the background
+        status (dict): updated with the `ready` and `pending` index names as they build
+    """
+    if status is None:
+        status = {}
+    indexes = await db.publications.index_information()
+    for name in OBSOLETE_INDEXES:
+        if name in indexes:
+            logging.info(f'dropping {name}')
+            await db.publications.drop_index(name)
+    status['ready'] = [name for name in INDEXES if name in indexes]
+    status['pending'] = [name for name in INDEXES if name not in indexes]
+    for name in list(status['pending']):
+        logging.info(f'creating {name}')
+        spec = dict(INDEXES[name])
+        await db.publications.create_index(spec.pop('keys'), name=name, background=background, **spec)
+        status['pending'].remove(name)
+        status['ready'].append(name)
+
+async def migrate_display_fields(db, batch_size=IMPORT_BATCH_SIZE):
+    """
+    Add the stored date, display, and revision fields to publications missing them.
+
+    Returns:
+        int: number of publications migrated
+    """
+    query = {'$or': [
+        {'datetime': {'$exists': False}},
+        {'date_display': {'$exists': False}},
+        {'download_domains': {'$exists': False}},
+        {'rev': {'$exists': False}},
+    ]}
+    count = 0
+    ops = []
+    async for p in db.publications.find(query):
+        try:
+            update = display_fields(p['date'], p.get('downloads', []))
+            update['rev'] = content_rev(p)
+        except (KeyError, TypeError, ValueError):
+            logging.warning(f'cannot migrate publication {p["_id"]}', exc_info=True)
+            continue
+        ops.append(pymongo.UpdateOne({'_id': p['_id']}, {'$set': update}))
+        if len(ops) >= batch_size:
+            await db.publications.bulk_write(ops, ordered=False)
+            count += len(ops)
+            ops = []
+    if ops:
+        await db.publications.bulk_write(ops, ordered=False)
+        count += len(ops)
+    if count:
+        logging.info(f'migrated display fields for {count} publications')
+        await bump_revision(db)
+    return count
+
+async def get_revision(db):
+    """
+    Get the current revision of the publications collection.
+
+    Returns:
+        tuple: (revision number, datetime of last modification or None)
+    """
+    ret = await db.metadata.find_one({'_id': 'revision'})
+    if not ret:
+        return 0, None
+    return ret['revision'], ret['modified']
+
+async def bump_revision(db):
+    """Record a write to the publications, and invalidate cached results"""
+    await db.metadata.update_one({'_id': 'revision'}, {
+        '$inc': {'revision': 1},
+        '$set': {'modified': datetime.utcnow().replace(microsecond=0)},
+    }, upsert=True)
+    invalidate_all()
+
+async def update_authors(db, added=(), removed=()):
+    """
+    Update publication counts in the author registry.
+
+    Each name in `added` or `removed` counts as one publication.
+    """
+    counts = Counter(added)
+    counts.subtract(removed)
+    ops = [pymongo.UpdateOne({'_id': a}, {'$inc': {'count': n}}, upsert=n > 0) for a, n in counts.items() if n]
+    if ops:
+        await db.authors.bulk_write(ops, ordered=False)
+    if any(n < 0 for n in counts.values()):
+        await db.authors.delete_many({'count': {'$lte': 0}})
+
+async def rebuild_authors(db):
+    """Rebuild the author registry from all publications"""
+    aggregation = [
+        {"$project": {"authors": {"$setUnion": ["$authors", []]}}},
+        {"$unwind": "$authors"},
+        {"$group": {"_id": "$authors", "count": {"$sum": 1}}},
+        {"$out": "authors"},
+    ]
+    await db.publications.aggregate(aggregation).to_list(None)
+
+async def migrate_authors(db):
+    """
+    Build the author registry, if it is empty but there are publications.
+
+    Returns:
+        bool: True if the registry was built
+    """
+    if await db.authors.find_one({}, projection={'_id': True}):
+        return False
+    if not await db.publications.find_one({}, projection={'_id': True}):
+        return False
+    await rebuild_authors(db)
+    logging.info(f'built the author registry with {await db.authors.count_documents({})} authors')
+    await bump_revision(db)
+    return True
 
 def validate(title, authors, pub_type, abstract, citation, date, downloads, projects, sites):
     assert isinstance(title, str)
@@ -72,7 +249,11 @@ async def add_pub(db, title, authors, pub_type, abstract, citation, date, downlo
         "projects": projects,
         "sites": sites,
     }
+    data.update(display_fields(date, downloads))
+    data['rev'] = content_rev(data)
     await db.publications.insert_one(data)
+    await update_authors(db, added=set(authors))
+    await bump_revision(db)
 
 async def edit_pub(db, mongo_id, title=None, authors=None, pub_type=None, abstract=None, citation=None, date=None, downloads=None, projects=None, sites=None):
     match = {'_id': ObjectId(mongo_id)}
@@ -96,13 +277,14 @@ async def edit_pub(db, mongo_id, title=None, authors=None, pub_type=None, abstra
         update['citation'] = citation
     if date is not None:
         assert isinstance(date, str)
-        date_format(date)
         update['date'] = date
+        update.update(display_fields(date=date))
     if downloads is not None:
         assert isinstance(downloads, list)
         for d in downloads:
             assert isinstance(d, str)
         update['downloads'] = downloads
+        update.update(display_fields(downloads=downloads))
     if projects is not None:
         assert isinstance(projects, list)
         for p in projects:
@@ -114,11 +296,37 @@ async def edit_pub(db, mongo_id, title=None, authors=None, pub_type=None, abstra
             assert s in SITES
         update['sites'] = sites
 
+    old = await db.publications.find_one(match)
+    if old:
+        update['rev'] = content_rev({**old, **update})
+
     await db.publications.update_one(match, {'$set': update})
+    if old and authors is not None:
+        await update_authors(db, added=set(authors), removed=set(old.get('authors', [])))
+    invalidate_fragments(mongo_id)
+    await bump_revision(db)
 
-async def try_import_file(db, data):
+async def delete_pub(db, mongo_id):
+    old = await db.publications.find_one_and_delete({'_id': ObjectId(mongo_id)}, projection={'authors': True})
+    if old:
+        await update_authors(db, removed=set(old.get('authors', [])))
+    invalidate_fragments(mongo_id)
+    await bump_revision(db)
+
+def parse_csv_row(row):
+    """Convert list columns of an imported csv row"""
+    for k in row:
+        val = row[k]
+        if k in ('downloads', 'projects', 'sites'):
+            row[k] = val.split(',') if val else []
+    return row
+
+async def try_import_file(db, data, batch_size=IMPORT_BATCH_SIZE):
     """
-    Try importing authors from file data (csv or json).
+    Try importing publications from file data (csv or json).
+
+    Returns:
+        dict: counts of inserted, updated, and unchanged publications
     """
     # parse the data
     try:
@@ -127,27 +335,63 @@ async def try_import_file(db, data):
             pubs = pubs['publications']
     except json.JSONDecodeError:
         try:
-            def parse_csv(row):
-                for k in row:
-                    val = row[k]
-                    if k in ('downloads', 'projects', 'sites'):
-                        row[k] = val.split(',') if val else []
-                return row
             with StringIO(data) as f:
                 reader = csv.DictReader(f)
-                pubs = [parse_csv(row) for row in reader]
+                pubs = [parse_csv_row(row) for row in reader]
         except csv.Error:
             raise Exception('File is not in a recognizable format. Only json or csv are valid.')
 
     # now validate
     for p in pubs:
-        if isinstance(p['authors'], str):
-            p['authors'] = [p['authors']]
-        try:
-            validate(p['title'], p['authors'], p['type'], p.get('abstract', ''), p['citation'], p['date'], p['downloads'], p['projects'], p['sites'])
-        except AssertionError:
-            raise Exception(f'Error validating pub with title {p["title"][:100]}')
+        validate_import(p)
 
     # now add:to db
-    for p in pubs:
-        await db.publications.replace_one({'title': p['title'], 'authors': p['authors'], 'date': p['date']}, p, upsert=True)
+    return await import_pubs(db, pubs, batch_size=batch_size)
+
+def validate_import(p):
+    """Normalize and validate an imported publication"""
+    if isinstance(p['authors'], str):
+        p['authors'] = [p['authors']]
+    try:
+        validate(p['title'], p['authors'], p['type'], p.get('abstract', ''), p['citation'], p['date'], p['downloads'], p['projects'], p['sites'])
+    except AssertionError:
+        raise Exception(f'Error validating pub with title {p["title"][:100]}')
+    p.update(display_fields(p['date'], p['downloads']))
+    p['rev'] = content_rev(p)
+
+async def import_batch(db, pubs):
+    """
+    Upsert a batch of validated publications in one unordered bulk write.
+
+    Publications are matched on title, authors, and date.
+
+    Returns:
+        dict: counts of inserted, updated, and unchanged publications
+    """
+    if not pubs:
+        return {'inserted': 0, 'updated': 0, 'unchanged': 0}
+    ops = [pymongo.ReplaceOne({'title': p['title'], 'authors': p['authors'], 'date': p['date']}, p, upsert=True) for p in pubs]
+    ret = await db.publications.bulk_write(ops, ordered=False)
+    added = [a for i in ret.upserted_ids for a in set(pubs[i]['authors'])]
+    await update_authors(db, added=added)
+    return {
+        'inserted': ret.upserted_count,
+        'updated': ret.modified_count,
+        'unchanged': ret.matched_count - ret.modified_count,
+    }
+
+async def import_pubs(db, pubs, batch_size=IMPORT_BATCH_SIZE):
+    """
+    Upsert validated publications in batches.
+
+    Returns:
+        dict: counts of inserted, updated, and unchanged publications
+    """
+    summary = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+    try:
+        for i in range(0, len(pubs), batch_size):
+            for k, v in (await import_batch(db, pubs[i:i+batch_size])).items():
+                summary[k] += v
+    finally:
+        await bump_revision(db)
+    return summary
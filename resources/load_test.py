@@ -0,0 +1,206 @@
+"""
+Load test a running server with a mix of realistic queries.
+
+Runs either closed-loop (CONCURRENCY clients, each sending a new
+request as soon as the last finishes), or open-loop at a target RATE of
+requests per second, with at most CONCURRENCY requests outstanding.
+In open-loop mode latency is measured from when a request was scheduled,
+so a server that falls behind is not hidden by fewer requests being sent.
+
+Set MIX to weight the query shapes, like `search=5,csv=1`. Shapes not
+listed are not sent. Default is every shape with equal weight.
+"""
+import asyncio
+import json
+import logging
+import math
+import random
+import time
+from collections import defaultdict
+from urllib.parse import urlencode
+
+from tornado.httpclient import AsyncHTTPClient
+from wipac_dev_tools import from_environment
+
+
+default_config = {
+    'URL': 'http://localhost:8080',
+    'CONCURRENCY': 10,
+    'RATE': 0.,  # requests per second, 0 for closed-loop
+    'DURATION': 60.,  # seconds
+    'MIX': '',  # shape=weight,shape=weight
+    'SEED': 0,
+    'OUTPUT': '',  # json results file
+}
+config = from_environment(default_config)
+
+
+class Shapes:
+    """
+    Query shapes, with argument values sampled from the server's data.
+
+    Each shape returns a (path, query args) pair.
+    """
+    def __init__(self, rand, projects, types, pubs):
+        self.rand = rand
+        self.projects = projects
+        self.types = types
+        self.sites = sorted({s for p in pubs for s in p.get('sites', [])}) or ['icecube']
+        self.authors = sorted({a for p in pubs for a in p['authors']}) or ['']
+        self.words = sorted({w for p in pubs for w in p['title'].split() if len(w) > 3}) or ['neutrino']
+        self.years = sorted({p['date'][:4] for p in pubs}) or ['2020']
+
+    def main(self):
+        return '/', {'projects': self.rand.choice(self.projects)}
+
+    def all(self):
+        return '/api/publications', {'limit': 100}
+
+    def project(self):
+        return '/api/publications', {'projects': self.rand.choice(self.projects), 'limit': 100}
+
+    def project_site(self):
+        return '/api/publications', {'projects': self.rand.choice(self.projects), 'sites': self.rand.choice(self.sites), 'limit': 100}
+
+    def search(self):
+        return '/api/publications', {'search': self.rand.choice(self.words), 'limit': 100}
+
+    def author(self):
+        return '/api/publications', {'authors': self.rand.choice(self.authors), 'limit': 100}
+
+    def date_range(self):
+        start = self.rand.choice(self.years)
+        return '/api/publications', {'start_date': f'{start}-01-01', 'end_date': f'{int(start)+2}-12-31',
+                                     'type': self.rand.choice(self.types), 'limit': 100}
+
+    def deep_page(self):
+        return '/api/publications', {'page': self.rand.randint(10, 100), 'limit': 50}
+
+    def count_filtered(self):
+        return '/api/publications/count', {'projects': self.rand.choice(self.projects)}
+
+    def csv(self):
+        return '/csv', {}
+
+    def csv_filtered(self):
+        return '/csv', {'projects': self.rand.choice(self.projects), 'start_date': f'{self.rand.choice(self.years)}-01-01'}
+
+SHAPES = [name for name in vars(Shapes) if not name.startswith('_')]
+
+
+def parse_mix(mix):
+    if not mix:
+        return {name: 1. for name in SHAPES}
+    ret = {}
+    for part in mix.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in SHAPES:
+            raise Exception(f'unknown shape {name}, must be one of {SHAPES}')
+        ret[name] = float(weight) if weight else 1.
+    return ret
+
+def percentile(values, p):
+    """Nearest-rank percentile of sorted values"""
+    if not values:
+        return None
+    return values[max(0, math.ceil(p / 100. * len(values)) - 1)]
+
+def summarize(results, elapsed):
+    """
+    Summarize latencies per shape.
+
+    Args:
+        results (dict): shape: list of (latency, ok)
+        elapsed (float): run time in seconds
+    """
+    ret = {}
+    for name, rows in sorted(results.items()):
+        latencies = sorted(lat for lat, ok in rows if ok)
+        ret[name] = {
+            'requests': len(rows),
+            'errors': sum(1 for _, ok in rows if not ok),
+            'throughput': len(rows) / elapsed,
+            'mean': sum(latencies) / len(latencies) if latencies else None,
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99),
+        }
+    return ret
+
+def print_summary(summary, elapsed):
+    def ms(v):
+        return '-' if v is None else f'{v*1000:.1f}'
+    print(f'{"shape":<16}{"requests":>10}{"errors":>8}{"req/s":>10}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}')
+    for name, s in summary.items():
+        print(f'{name:<16}{s["requests"]:>10}{s["errors"]:>8}{s["throughput"]:>10.1f}'
+              f'{ms(s["p50"]):>10}{ms(s["p95"]):>10}{ms(s["p99"]):>10}')
+    total = sum(s['requests'] for s in summary.values())
+    print(f'total: {total} requests in {elapsed:.1f}s, {total/elapsed:.1f} req/s')
+
+
+async def main():
+    rand = random.Random(config['SEED'])
+    url = config['URL'].rstrip('/')
+    mix = parse_mix(config['MIX'])
+    names, weights = list(mix), list(mix.values())
+
+    AsyncHTTPClient.configure(None, max_clients=config['CONCURRENCY'])
+    client = AsyncHTTPClient()
+
+    # sample real values for the filters
+    projects = list(json.loads((await client.fetch(f'{url}/api/projects')).body))
+    types = list(json.loads((await client.fetch(f'{url}/api/types')).body))
+    pubs = json.loads((await client.fetch(f'{url}/api/publications?limit=1000')).body)['publications']
+    shapes = Shapes(rand, projects, types, pubs)
+    logging.info(f'sampled filters from {len(pubs)} publications')
+
+    results = defaultdict(list)
+
+    async def send(name, scheduled):
+        path, args = getattr(shapes, name)()
+        ok = True
+        try:
+            await client.fetch(f'{url}{path}?{urlencode(args)}', request_timeout=600)
+        except Exception as e:
+            logging.debug(f'{name} failed: {e}')
+            ok = False
+        results[name].append((time.monotonic() - scheduled, ok))
+
+    start = time.monotonic()
+    end = start + config['DURATION']
+    if config['RATE'] > 0:
+        # open-loop: schedule requests at the target rate
+        sem = asyncio.Semaphore(config['CONCURRENCY'])
+        tasks = set()
+
+        async def run(name, scheduled):
+            async with sem:
+                await send(name, scheduled)
+
+        i = 0
+        while (scheduled := start + i / config['RATE']) < end:
+            await asyncio.sleep(max(0, scheduled - time.monotonic()))
+            task = asyncio.create_task(run(rand.choices(names, weights)[0], scheduled))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            i += 1
+        if tasks:
+            await asyncio.wait(tasks)
+    else:
+        # closed-loop: each client sends its next request when the last is done
+        async def worker():
+            while time.monotonic() < end:
+                await send(rand.choices(names, weights)[0], time.monotonic())
+        await asyncio.gather(*[worker() for _ in range(config['CONCURRENCY'])])
+    elapsed = time.monotonic() - start
+
+    summary = summarize(results, elapsed)
+    print_summary(summary, elapsed)
+    if config['OUTPUT']:
+        with open(config['OUTPUT'], 'w') as f:
+            json.dump({'config': config, 'elapsed': elapsed, 'shapes': summary}, f, indent=2)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
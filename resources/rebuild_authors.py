@@ -0,0 +1,34 @@
+"""
+Rebuild the author registry from all publications.
+"""
+import os
+import sys
+import asyncio
+import logging
+
+import motor.motor_asyncio
+from wipac_dev_tools import from_environment
+
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from pubs.utils import rebuild_authors
+
+
+default_config = {
+    'DB_URL': 'mongodb://localhost/pub_db',
+}
+config = from_environment(default_config)
+
+
+async def main():
+    logging.info(f'DB: {config["DB_URL"]}')
+    db_url, db_name = config['DB_URL'].rsplit('/', 1)
+    logging.info(f'DB name: {db_name}')
+    db = motor.motor_asyncio.AsyncIOMotorClient(db_url)[db_name]
+
+    await rebuild_authors(db)
+    logging.info(f'{await db.authors.count_documents({})} authors')
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    asyncio.run(main())
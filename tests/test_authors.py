@@ -0,0 +1,48 @@
+import pytest
+
+from pubs.authors import AuthorIndex, fold
+
+def test_fold():
+    assert fold('Ångström, Ä.') == 'angstrom, a.'
+
+def test_suggest():
+    index = AuthorIndex()
+    index.build(['Aartsen, M.G.', 'Ackermann, M.', 'Ångström, A.', 'J. van Santen', 'Sánchez, F.'])
+    assert sorted(index.suggest('a')) == ['Aartsen, M.G.', 'Ackermann, M.', 'Ångström, A.']
+    assert index.suggest('ÄC') == ['Ackermann, M.']
+    assert index.suggest('ang') == ['Ångström, A.']
+    assert index.suggest('san') == ['Sánchez, F.', 'J. van Santen']
+    assert index.suggest('van  s') == ['J. van Santen']
+    assert len(index.suggest('a', limit=2)) == 2
+    assert index.suggest('') == []
+    assert index.suggest('zzz') == []
+
+class FakeCursor:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def __aiter__(self):
+        return self._iter()
+
+    async def _iter(self):
+        for row in self.rows:
+            yield row
+
+@pytest.mark.asyncio
+async def test_refresh(mocker):
+    db = mocker.MagicMock()
+    db.authors.find.return_value = FakeCursor([{'_id': 'auth1'}])
+    get_revision = mocker.patch('pubs.authors.get_revision', return_value=(1, None))
+
+    index = AuthorIndex()
+    await index.refresh(db)
+    assert index.suggest('auth') == ['auth1']
+
+    db.authors.find.return_value = FakeCursor([{'_id': 'auth1'}, {'_id': 'auth2'}])
+    await index.refresh(db)
+    assert index.suggest('auth') == ['auth1']
+
+    get_revision.return_value = (2, None)
+    await index.refresh(db)
+    assert index.suggest('auth') == ['auth1', 'auth2']
+    assert db.authors.find.call_count == 2
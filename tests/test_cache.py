@@ -0,0 +1,116 @@
+import pytest
+
+import pubs.cache
+import pubs.utils
+from pubs.cache import QueryCache, FragmentCache, make_key
+
+def test_make_key():
+    assert make_key('pubs', {'projects': {'$all': ['a', 'b']}}) == make_key('pubs', {'projects': {'$all': ['b', 'a']}})
+    assert make_key('pubs', {'a': 1, 'b': 2}) == make_key('pubs', {'b': 2, 'a': 1})
+    assert make_key('pubs', {'a': 1}) != make_key('count', {'a': 1})
+    assert make_key('pubs', {}, '1', '2') != make_key('pubs', {}, '2', '1')
+
+def test_cache():
+    c = QueryCache(maxsize=2)
+    assert c.get('a') is None
+    c.set('a', 1)
+    assert c.get('a') == 1
+    assert c.stats()['hits'] == 1
+    assert c.stats()['misses'] == 1
+
+def test_cache_lru():
+    c = QueryCache(maxsize=2)
+    c.set('a', 1)
+    c.set('b', 2)
+    c.get('a')
+    c.set('c', 3)
+    assert c.get('b') is None
+    assert c.get('a') == 1
+    assert c.get('c') == 3
+    assert c.stats()['evictions'] == 1
+    assert len(c) == 2
+
+def test_cache_ttl(mocker):
+    t = mocker.patch('time.monotonic', return_value=100.)
+    c = QueryCache(maxsize=2, ttl=10)
+    c.set('a', 1)
+    t.return_value = 105.
+    assert c.get('a') == 1
+    t.return_value = 111.
+    assert c.get('a') is None
+    assert len(c) == 0
+
+def test_cache_maxbytes():
+    c = QueryCache(maxsize=10, maxbytes=20)
+    c.set('a', 'x' * 10)
+    c.set('b', 'y' * 10)
+    assert c.stats()['bytes'] == 20
+    c.set('c', 'z' * 10)
+    assert c.get('a') is None
+    assert c.get('b') == 'y' * 10
+    assert c.stats()['bytes'] == 20
+    assert c.stats()['evictions'] == 1
+
+    # too large to cache at all
+    c.set('d', 'w' * 21)
+    assert c.get('d') is None
+    assert len(c) == 2
+
+    c.clear()
+    assert c.stats()['bytes'] == 0
+
+def test_approx_size():
+    assert pubs.cache.approx_size({'ab': 'cde', 'f': ['gh', 1]}) == 3 + 3 + 2 + 8
+    assert pubs.cache.approx_size(['x' * 10] * 100, limit=25) < 100
+
+def test_cache_disabled():
+    c = QueryCache(maxsize=0)
+    c.set('a', 1)
+    assert c.get('a') is None
+
+@pytest.mark.asyncio
+async def test_invalidate_all(mocker):
+    c1 = QueryCache()
+    c2 = QueryCache()
+    c1.set('a', 1)
+    c2.set('a', 1)
+    pubs.cache.invalidate_all()
+    assert c1.get('a') is None
+    assert c2.get('a') is None
+
+    c1.set('a', 1)
+    db = mocker.AsyncMock()
+    db.publications.find_one_and_delete.return_value = None
+    await pubs.utils.delete_pub(db, '5fa1b2c3d4e5f6a7b8c9d0e1')
+    assert c1.get('a') is None
+
+def test_fragment_cache():
+    c = FragmentCache(maxbytes=10)
+    assert c.get('a', 'rev1') is None
+    c.set('a', 'rev1', 'abcd')
+    assert c.get('a', 'rev1') == 'abcd'
+    assert c.get('a', 'rev2') is None
+    assert c.get('a', 'rev1', 'variant') is None
+    c.set('a', 'rev1', 'ef', 'variant')
+    assert c.get('a', 'rev1', 'variant') == 'ef'
+    assert c.stats()['bytes'] == 6
+
+    c.set('b', 'rev1', 'ghijk')
+    assert c.get('a', 'rev1') is None
+    assert c.get('a', 'rev1', 'variant') == 'ef'
+    assert c.stats()['bytes'] == 7
+    assert c.stats()['evictions'] == 1
+
+    c.set('c', 'rev1', 'x' * 11)
+    assert c.get('c', 'rev1') is None
+
+def test_fragment_cache_invalidate():
+    c = FragmentCache()
+    c.set('a', 'rev1', 'abcd')
+    c.set('a', 'rev1', 'ef', 'variant')
+    c.set('b', 'rev1', 'ghijk')
+    pubs.cache.invalidate_fragments('a')
+    assert c.get('a', 'rev1') is None
+    assert c.get('a', 'rev1', 'variant') is None
+    assert c.get('b', 'rev1') == 'ghijk'
+    assert c.stats()['bytes'] == 5
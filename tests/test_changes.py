@@ -0,0 +1,90 @@
+import asyncio
+
+import pytest
+from bson.objectid import ObjectId
+
+from pubs.cache import QueryCache, FragmentCache
+from pubs.changes import ChangeFeed, matches, MAX_QUEUE_SIZE
+
+PUB = {'title': 'foo', 'authors': ['bar'], 'type': 'journal', 'citation': 'cite', 'date': '2020-01-01T00:00:00',
+       'abstract': '', 'downloads': [], 'projects': ['icecube', 'hawc'], 'sites': ['wipac'],
+       'datetime': None, 'rev': 'abc'}
+
+def change(op, pub=None):
+    _id = ObjectId()
+    ret = {'operationType': op, 'documentKey': {'_id': _id}}
+    if pub is not None:
+        ret['fullDocument'] = {'_id': _id, **pub}
+    return ret
+
+@pytest.mark.parametrize('filters,expected', [
+    ({}, True),
+    ({'projects': ['icecube']}, True),
+    ({'projects': ['icecube', 'hawc']}, True),
+    ({'projects': ['icecube', 'ara']}, False),
+    ({'sites': ['wipac']}, True),
+    ({'sites': ['icecube']}, False),
+    ({'type': ['journal', 'thesis']}, True),
+    ({'type': ['thesis']}, False),
+    ({'projects': ['hawc'], 'type': ['thesis']}, False),
+])
+def test_matches(filters, expected):
+    assert matches(filters, PUB) == expected
+
+@pytest.mark.asyncio
+async def test_dispatch(mocker):
+    feed = ChangeFeed(mocker.MagicMock())
+    with feed.subscribe() as all_q, feed.subscribe({'projects': ['ara']}) as ara_q:
+        c = change('insert', PUB)
+        feed.dispatch(c)
+        event = all_q.get_nowait()
+        assert event['type'] == 'insert'
+        assert event['_id'] == str(c['documentKey']['_id'])
+        assert event['publication']['title'] == 'foo'
+        assert 'rev' not in event['publication']
+        assert ara_q.empty()
+
+        c = change('replace', PUB)
+        feed.dispatch(c)
+        assert all_q.get_nowait()['type'] == 'update'
+        # may have matched before the update
+        assert ara_q.get_nowait() == {'type': 'removed', '_id': str(c['documentKey']['_id'])}
+
+        feed.dispatch(change('delete'))
+        assert all_q.get_nowait()['type'] == 'delete'
+        assert ara_q.get_nowait()['type'] == 'delete'
+
+        # updated, then deleted before the lookup
+        feed.dispatch(change('update'))
+        assert all_q.empty()
+    assert not feed.subscribers
+
+@pytest.mark.asyncio
+async def test_dispatch_invalidates(mocker):
+    cache = QueryCache()
+    cache.set('foo', 1)
+    fragments = FragmentCache()
+    c = change('update', PUB)
+    fragments.set(c['documentKey']['_id'], 'rev', '<article>')
+
+    feed = ChangeFeed(mocker.MagicMock())
+    feed.dispatch(c)
+    assert cache.get('foo') is None
+    assert fragments.get(c['documentKey']['_id'], 'rev') is None
+
+@pytest.mark.asyncio
+async def test_slow_subscriber(mocker):
+    feed = ChangeFeed(mocker.MagicMock())
+    with feed.subscribe() as q:
+        for _ in range(MAX_QUEUE_SIZE + 1):
+            feed.dispatch(change('insert', PUB))
+        assert q not in feed.subscribers
+        events = [q.get_nowait() for _ in range(q.qsize())]
+        assert events[-1] is None
+
+@pytest.mark.asyncio
+async def test_stop(mocker):
+    feed = ChangeFeed(mocker.MagicMock())
+    with feed.subscribe() as q:
+        feed.stop()
+        assert await asyncio.wait_for(q.get(), 1) is None
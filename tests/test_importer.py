@@ -0,0 +1,101 @@
+import pytest
+from bson.objectid import ObjectId
+
+from pubs.importer import CSVStreamParser, JSONStreamParser, MultipartParser, StreamImporter
+
+CSV_DATA = '''title,authors,type,abstract,citation,date,downloads,projects,sites
+foo,bar,journal,"this is an
+abstract, with ""quotes""",cite,2020-11-03T00:00:00,baz,icecube,"icecube,wipac"
+foo2,bar,journal,,cite,2020-11-04T00:00:00,,icecube,wipac
+'''
+
+JSON_DATA = '''{"projects": [], "count": 2, "publications": [
+{"title":"foo","authors":["bar"],"type":"journal","citation":"cite",
+"date":"2020-11-03T00:00:00","downloads":["baz"],"projects":["icecube"],"sites":["icecube","wipac"]},
+{"title":"foo2 ]}","authors":["bar"],"type":"journal","citation":"cite",
+"date":"2020-11-04T00:00:00","downloads":[],"projects":["icecube"],"sites":["wipac"]}
+], "after": null}'''
+
+def chunked(data, size):
+    return [data[i:i+size] for i in range(0, len(data), size)]
+
+def parse(parser, data, size):
+    pubs = []
+    for chunk in chunked(data, size):
+        pubs += parser.feed(chunk)
+    return pubs + parser.close()
+
+@pytest.mark.parametrize('size', [1, 7, 1000])
+def test_csv_parser(size):
+    pubs = parse(CSVStreamParser(), CSV_DATA, size)
+    assert len(pubs) == 2
+    assert pubs[0]['abstract'] == 'this is an\nabstract, with "quotes"'
+    assert pubs[0]['sites'] == ['icecube', 'wipac']
+    assert pubs[1]['downloads'] == []
+
+def test_csv_parser_err():
+    with pytest.raises(Exception):
+        parse(CSVStreamParser(), 'title,authors\n"foo,bar\n', 1000)
+
+@pytest.mark.parametrize('size', [1, 7, 1000])
+def test_json_parser(size):
+    pubs = parse(JSONStreamParser(), JSON_DATA, size)
+    assert [p['title'] for p in pubs] == ['foo', 'foo2 ]}']
+
+    data = JSON_DATA[JSON_DATA.index('[\n{'):JSON_DATA.rindex(']')+1]
+    pubs = parse(JSONStreamParser(), data, size)
+    assert [p['title'] for p in pubs] == ['foo', 'foo2 ]}']
+
+@pytest.mark.parametrize('data', ['[{"title": "foo"}', '{"publications": 12}', '[1, 2]', '{"foo": ]'])
+def test_json_parser_err(data):
+    with pytest.raises(Exception):
+        parse(JSONStreamParser(), data, 1000)
+
+@pytest.mark.parametrize('size', [1, 5, 1000])
+@pytest.mark.asyncio
+async def test_multipart_parser(size):
+    body = (b'--XyZ\r\nContent-Disposition: form-data; name="action"\r\n\r\nimport\r\n'
+            b'--XyZ\r\nContent-Disposition: form-data; name="import_file"; filename="a.csv"\r\n'
+            b'Content-Type: text/csv\r\n\r\nline1\r\n--Xy\r\n'
+            b'--XyZ--\r\n')
+    data = []
+    ends = []
+
+    async def on_data(d):
+        data.append(d)
+
+    async def on_end():
+        ends.append(len(data))
+
+    parser = MultipartParser(b'XyZ', on_data, on_end)
+    for chunk in chunked(body, size):
+        await parser.feed(chunk)
+    parser.close()
+    assert b''.join(data) == b'line1\r\n--Xy'
+    assert len(ends) == 1
+
+@pytest.mark.asyncio
+async def test_stream_importer(mocker):
+    db = mocker.AsyncMock()
+    db.publications.bulk_write.return_value = mocker.MagicMock(upserted_count=1, matched_count=0,
+                                                               modified_count=0, upserted_ids={0: ObjectId()})
+    importer = StreamImporter(db, batch_size=1)
+    for chunk in chunked(('﻿' + CSV_DATA).encode('utf-8'), 10):
+        await importer.feed(chunk)
+    await importer.end_file()
+    for chunk in chunked(JSON_DATA.encode('utf-8'), 10):
+        await importer.feed(chunk)
+    await importer.end_file()
+    await importer.flush()
+
+    assert importer.files == 2
+    assert db.publications.bulk_write.call_count == 4
+    assert importer.summary == {'inserted': 4, 'updated': 0, 'unchanged': 0}
+
+@pytest.mark.asyncio
+async def test_stream_importer_invalid(mocker):
+    db = mocker.AsyncMock()
+    importer = StreamImporter(db)
+    with pytest.raises(Exception):
+        await importer.feed(b'[{"title": "foo"}]')
+        await importer.end_file()
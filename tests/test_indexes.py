@@ -0,0 +1,90 @@
+import pytest
+import pytest_asyncio
+import pymongo
+
+from pubs.server import BaseHandler, filters_to_match_query
+from pubs.utils import add_pub, encode_after_token
+
+from .util import mongo_client
+
+SORT = [('datetime', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)]
+
+# every filter shape the handlers produce, with the date sort
+SHAPES = [
+    {},
+    {'projects': ['icecube']},
+    {'projects': ['icecube', 'hawc']},
+    {'sites': ['wipac']},
+    {'type': ['journal']},
+    {'type': ['journal', 'thesis']},
+    {'authors': ['auth1']},
+    {'authors': ['auth1', 'auth2']},
+    {'start_date': '2020-02-01'},
+    {'end_date': '2020-02-01'},
+    {'start_date': '2020-01-01', 'end_date': '2020-02-01'},
+    {'projects': ['icecube'], 'sites': ['wipac']},
+    {'projects': ['icecube'], 'type': ['journal']},
+    {'projects': ['icecube'], 'authors': ['auth1']},
+    {'projects': ['icecube'], 'start_date': '2020-01-01', 'end_date': '2020-02-01'},
+    {'sites': ['wipac'], 'type': ['journal', 'thesis']},
+    {'sites': ['icecube'], 'start_date': '2020-01-01'},
+    {'type': ['thesis'], 'end_date': '2020-02-01'},
+    {'authors': ['auth2'], 'type': ['journal']},
+    # keyset pages, after a (datetime, _id) position
+    {'after': True},
+    {'projects': ['icecube'], 'after': True},
+    {'type': ['journal', 'thesis'], 'start_date': '2020-01-01', 'after': True},
+    {'authors': ['auth1'], 'after': True},
+]
+
+# text matches come from the text index, which cannot provide the date sort
+TEXT_SHAPES = [
+    {'search': 'title'},
+    {'search': 'title', 'projects': ['icecube']},
+    {'search': 'title', 'type': ['journal'], 'start_date': '2020-01-01'},
+]
+
+def plan_stages(plan):
+    """Get all stage names in an explain plan"""
+    stages = []
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            stages.append(plan['stage'])
+        for v in plan.values():
+            stages.extend(plan_stages(v))
+    elif isinstance(plan, list):
+        for v in plan:
+            stages.extend(plan_stages(v))
+    return stages
+
+@pytest_asyncio.fixture
+async def corpus(mongo_client):
+    for i in range(20):
+        await add_pub(mongo_client, title=f'Test Title{i}', authors=[f'auth{i%3}', f'auth{i%5}'], abstract='',
+                      pub_type=['journal', 'proceeding', 'thesis'][i % 3], citation='TestJournal',
+                      date=f'2020-{i%12+1:02d}-01', downloads=[],
+                      projects=['icecube', 'hawc'][:i%2+1], sites=['icecube', 'wipac'][i%2:])
+    return mongo_client
+
+@pytest.mark.parametrize('filters', SHAPES)
+@pytest.mark.asyncio
+async def test_explain(corpus, filters):
+    match = filters_to_match_query(filters)
+    if filters.get('after'):
+        last = await corpus.publications.find(match).sort(SORT).limit(5).to_list(None)
+        token = encode_after_token(last[-1]['datetime'], last[-1]['_id'])
+        page_match, _, _, _ = BaseHandler.args_to_page_query(None, 'date', {'page': None, 'limit': 5, 'after': token})
+        match.update(page_match)
+    explain = await corpus.publications.find(match).sort(SORT).explain()
+    stages = plan_stages(explain['queryPlanner']['winningPlan'])
+    assert 'COLLSCAN' not in stages
+    assert 'SORT' not in stages
+
+@pytest.mark.parametrize('filters', TEXT_SHAPES)
+@pytest.mark.asyncio
+async def test_explain_text(corpus, filters):
+    match = filters_to_match_query(filters)
+    explain = await corpus.publications.find(match).sort(SORT).explain()
+    stages = plan_stages(explain['queryPlanner']['winningPlan'])
+    assert 'COLLSCAN' not in stages
+    assert any(s.startswith('TEXT') for s in stages)
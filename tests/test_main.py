@@ -1,10 +1,14 @@
 import asyncio
+import json
 
 import pytest
 from rest_tools.client import AsyncSession
+from tornado.httpclient import AsyncHTTPClient
 from bs4 import BeautifulSoup
 
-from pubs.utils import nowstr, add_pub
+import pubs.server
+import pubs.utils as pubs_utils
+from pubs.utils import nowstr, add_pub, edit_pub
 
 from .util import port, mongo_client, server
 
@@ -328,3 +332,609 @@ async def test_csv_unsorted(server):
     assert 'Test Title2' in lines[2]
     assert 'Test Title3' in lines[3]
     assert 'Test Title4' in lines[4]
+
+
+@pytest.mark.asyncio
+async def test_api_pagination(server):
+    db, url = server
+
+    for i in range(5):
+        await add_pub(db, title=f'Test Title{i}', authors=['auth'], abstract='',
+                      pub_type="journal", citation="TestJournal", date=f'2020-01-0{i+1}',
+                      downloads=[], projects=['icecube'])
+
+    s = AsyncSession(retries=0, backoff_factor=1)
+    r = await asyncio.wrap_future(s.get(url+'/api/publications', params={'page': 1, 'limit': 2}))
+    r.raise_for_status()
+    data = r.json()
+    assert [p['title'] for p in data['publications']] == ['Test Title2', 'Test Title1']
+    assert '_id' not in data['publications'][0]
+
+    titles = []
+    params = {'limit': 2}
+    while True:
+        r = await asyncio.wrap_future(s.get(url+'/api/publications', params=params))
+        r.raise_for_status()
+        data = r.json()
+        titles.extend(p['title'] for p in data['publications'])
+        if not data['after']:
+            break
+        params['after'] = data['after']
+    assert titles == [f'Test Title{i}' for i in reversed(range(5))]
+
+    r = await asyncio.wrap_future(s.get(url+'/api/publications', params={'after': 'foo'}))
+    assert r.status_code == 400
+
+@pytest.mark.asyncio
+async def test_api_pagination_unmigrated(server):
+    db, url = server
+
+    for i in range(3):
+        await add_pub(db, title=f'Test Title{i}', authors=['auth'], abstract='',
+                      pub_type="journal", citation="TestJournal", date=f'2020-01-0{i+1}',
+                      downloads=[], projects=['icecube'])
+    # stored before the display fields existed, or with a date that cannot be parsed
+    for i, date in enumerate(['2021-01-01', 'unknown'], 3):
+        await db.publications.insert_one({'title': f'Test Title{i}', 'authors': ['auth'], 'abstract': '',
+                                          'type': 'journal', 'citation': 'TestJournal', 'date': date,
+                                          'downloads': [], 'projects': ['icecube'], 'sites': []})
+
+    s = AsyncSession(retries=0, backoff_factor=1)
+    titles = []
+    params = {'limit': 2}
+    while True:
+        r = await asyncio.wrap_future(s.get(url+'/api/publications', params=params))
+        r.raise_for_status()
+        data = r.json()
+        titles.extend(p['title'] for p in data['publications'])
+        if not data['after']:
+            break
+        params['after'] = data['after']
+    assert titles == ['Test Title2', 'Test Title1', 'Test Title0', 'Test Title4', 'Test Title3']
+
+
+@pytest.mark.asyncio
+async def test_api_with_count(server):
+    db, url = server
+
+    for i in range(5):
+        await add_pub(db, title=f'Test Title{i}', authors=['auth'], abstract='',
+                      pub_type="journal", citation="TestJournal", date=f'2020-01-0{i+1}',
+                      downloads=[], projects=['icecube' if i % 2 else 'hawc'])
+
+    s = AsyncSession(retries=0, backoff_factor=1)
+    r = await asyncio.wrap_future(s.get(url+'/api/publications', params={'with_count': 'true', 'page': 0, 'limit': 2}))
+    r.raise_for_status()
+    data = r.json()
+    assert data['count'] == 5
+    assert [p['title'] for p in data['publications']] == ['Test Title4', 'Test Title3']
+
+    r = await asyncio.wrap_future(s.get(url+'/api/publications', params={'with_count': 'true', 'projects': 'hawc', 'page': 1, 'limit': 2}))
+    r.raise_for_status()
+    data = r.json()
+    assert data['count'] == 3
+    assert [p['title'] for p in data['publications']] == ['Test Title0']
+    assert '_id' not in data['publications'][0]
+
+    r = await asyncio.wrap_future(s.get(url+'/api/publications', params={'with_count': 'true', 'projects': 'hawc'}))
+    r.raise_for_status()
+    data = r.json()
+    assert data['count'] == 3
+    assert [p['title'] for p in data['publications']] == ['Test Title4', 'Test Title2', 'Test Title0']
+    assert 'datetime' not in data['publications'][0]
+
+    r = await asyncio.wrap_future(s.get(url+'/api/publications', params={'projects': 'hawc'}))
+    r.raise_for_status()
+    assert 'count' not in r.json()
+
+
+@pytest.mark.asyncio
+async def test_csv_chunked(server, monkeypatch):
+    db, url = server
+    monkeypatch.setattr(pubs.server, 'STREAM_CHUNK_SIZE', 100)
+    monkeypatch.setattr(pubs.server, 'STREAM_BATCH_SIZE', 3)
+
+    for i in range(20):
+        await add_pub(db, title=f'Test Title{i:02d}', authors=['auth1'], abstract='',
+                      pub_type="journal", citation="TestJournal", date=f'2024-01-{i+1:02d}',
+                      downloads=[], projects=['icecube', 'hawc'])
+
+    s = AsyncSession(retries=0, backoff_factor=1)
+    r = await asyncio.wrap_future(s.get(url+'/csv'))
+    r.raise_for_status()
+    assert r.headers['Content-Type'].startswith('text/csv')
+
+    lines = r.text.strip().split('\n')
+    assert len(lines) == 21
+    for i, line in enumerate(lines[1:]):
+        assert f'Test Title{19-i:02d}' in line
+        assert '"hawc,icecube"' in line
+
+
+@pytest.mark.asyncio
+async def test_api_ndjson(server, monkeypatch):
+    db, url = server
+    monkeypatch.setattr(pubs.server, 'STREAM_CHUNK_SIZE', 100)
+
+    for i in range(10):
+        await add_pub(db, title=f'Test Title{i}', authors=['auth1'], abstract='the abstract',
+                      pub_type="journal", citation="TestJournal", date=f'2024-01-{i+1:02d}T01:00:00',
+                      downloads=[], projects=['icecube'])
+
+    s = AsyncSession(retries=0, backoff_factor=1)
+    r = await asyncio.wrap_future(s.get(url+'/api/publications', params={'format': 'ndjson'}))
+    r.raise_for_status()
+    assert r.headers['Content-Type'].startswith('application/x-ndjson')
+    rows = [json.loads(line) for line in r.text.strip().split('\n')]
+    assert [p['title'] for p in rows] == [f'Test Title{i}' for i in reversed(range(10))]
+    assert '_id' not in rows[0]
+
+    r = await asyncio.wrap_future(s.get(url+'/api/publications', params={'limit': 3},
+                                        headers={'Accept': 'application/x-ndjson'}))
+    r.raise_for_status()
+    rows = [json.loads(line) for line in r.text.strip().split('\n')]
+    assert len(rows) == 3
+    assert 'Accept' in r.headers['Vary']
+
+    r = await asyncio.wrap_future(s.get(url+'/api/publications', params={'limit': 3},
+                                        headers={'Accept': 'application/x-ndjson', 'If-None-Match': r.headers['ETag']}))
+    assert r.status_code == 304
+    assert 'Accept' in r.headers['Vary']
+
+
+@pytest.mark.asyncio
+async def test_cache_invalidation(server):
+    db, url = server
+
+    await add_pub(db, title='Test Title1', authors=['auth'], abstract='',
+                  pub_type="journal", citation="TestJournal", date='2020-01-02',
+                  downloads=[], projects=['icecube'])
+
+    pubs = await get_pubs(url, params={'projects': 'icecube'})
+    assert len(pubs) == 1
+
+    await add_pub(db, title='Test Title2', authors=['auth'], abstract='',
+                  pub_type="journal", citation="TestJournal", date='2020-02-03',
+                  downloads=[], projects=['icecube'])
+
+    pubs = await get_pubs(url, params={'projects': 'icecube'})
+    assert len(pubs) == 2
+
+
+@pytest.mark.asyncio
+async def test_cache_other_process_write(server, monkeypatch):
+    db, url = server
+
+    await add_pub(db, title='Test Title1', authors=['auth'], abstract='',
+                  pub_type="journal", citation="TestJournal", date='2020-01-02',
+                  downloads=[], projects=['icecube'])
+
+    s = AsyncSession(retries=0, backoff_factor=1)
+    r = await asyncio.wrap_future(s.get(url+'/api/publications/count'))
+    assert r.json()['count'] == 1
+    r = await asyncio.wrap_future(s.get(url+'/api/publications', params={'limit': 10}))
+    assert len(r.json()['publications']) == 1
+
+    # a write from another process does not clear this process's caches
+    monkeypatch.setattr(pubs_utils, 'invalidate_all', lambda: None)
+    await add_pub(db, title='Test Title2', authors=['auth'], abstract='',
+                  pub_type="journal", citation="TestJournal", date='2020-02-03',
+                  downloads=[], projects=['icecube'])
+
+    r = await asyncio.wrap_future(s.get(url+'/api/publications/count'))
+    assert r.json()['count'] == 2
+    r = await asyncio.wrap_future(s.get(url+'/api/publications', params={'limit': 10}))
+    assert len(r.json()['publications']) == 2
+
+
+@pytest.mark.asyncio
+async def test_cache_unbounded(server):
+    db, url = server
+
+    await add_pub(db, title='Test Title1', authors=['auth'], abstract='',
+                  pub_type="journal", citation="TestJournal", date='2020-01-02',
+                  downloads=[], projects=['icecube'])
+
+    s = AsyncSession(retries=0, backoff_factor=1)
+
+    async def cache_size():
+        r = await asyncio.wrap_future(s.get(url+'/metrics'))
+        return [line for line in r.text.split('\n') if line.startswith('pubs_cache_size{cache="query"}')]
+
+    # the whole matching corpus is not cached
+    pubs = await get_pubs(url)
+    assert len(pubs) == 1
+    r = await asyncio.wrap_future(s.get(url+'/api/publications'))
+    assert len(r.json()['publications']) == 1
+    assert await cache_size() == ['pubs_cache_size{cache="query"} 0']
+
+    r = await asyncio.wrap_future(s.get(url+'/api/publications', params={'limit': 10}))
+    assert len(r.json()['publications']) == 1
+    assert await cache_size() == ['pubs_cache_size{cache="query"} 1']
+
+
+@pytest.mark.parametrize('path', ['/', '/csv', '/api/publications', '/api/publications/count'])
+@pytest.mark.asyncio
+async def test_etag(server, path):
+    db, url = server
+
+    await add_pub(db, title='Test Title1', authors=['auth'], abstract='',
+                  pub_type="journal", citation="TestJournal", date='2020-01-02',
+                  downloads=[], projects=['icecube'])
+
+    s = AsyncSession(retries=0, backoff_factor=1)
+    r = await asyncio.wrap_future(s.get(url+path, params={'projects': 'icecube'}))
+    r.raise_for_status()
+    etag = r.headers['ETag']
+    assert 'Last-Modified' in r.headers
+
+    r = await asyncio.wrap_future(s.get(url+path, params={'projects': 'icecube'}, headers={'If-None-Match': etag}))
+    assert r.status_code == 304
+
+    r = await asyncio.wrap_future(s.get(url+path, params={'projects': 'hawc'}, headers={'If-None-Match': etag}))
+    assert r.status_code == 200
+    assert r.headers['ETag'] != etag
+
+    await add_pub(db, title='Test Title2', authors=['auth'], abstract='',
+                  pub_type="journal", citation="TestJournal", date='2020-02-03',
+                  downloads=[], projects=['icecube'])
+
+    r = await asyncio.wrap_future(s.get(url+path, params={'projects': 'icecube'}, headers={'If-None-Match': etag}))
+    assert r.status_code == 200
+    assert r.headers['ETag'] != etag
+
+
+@pytest.mark.asyncio
+async def test_ready(server):
+    db, url = server
+
+    s = AsyncSession(retries=0, backoff_factor=1)
+    for _ in range(100):
+        r = await asyncio.wrap_future(s.get(url+'/ready'))
+        r.raise_for_status()
+        data = r.json()
+        assert data['ready'] is True
+        if not data['indexes']['pending']:
+            break
+        await asyncio.sleep(.1)
+    assert 'text_index' in data['indexes']['ready']
+    assert data['indexes']['error'] is None
+
+
+@pytest.mark.asyncio
+async def test_fragment_cache_edit(server):
+    db, url = server
+
+    await add_pub(db, title='Test Title1', authors=['auth'], abstract='',
+                  pub_type="journal", citation="TestJournal", date='2020-01-02',
+                  downloads=['https://arxiv.org/abs/1234'], projects=['icecube'])
+
+    for _ in range(2):
+        pubs = await get_pubs(url)
+        assert len(pubs) == 1
+        assert pubs[0].select('.title')[0].string == 'Test Title1'
+        assert pubs[0].select('.download a')[0].string == 'arxiv.org'
+
+    pubs = await get_pubs(url, params={'hide_projects': 'true'})
+    assert pubs[0].select('.project') == []
+
+    pub = await db.publications.find_one({})
+    await edit_pub(db, pub['_id'], title='Test Title2')
+
+    pubs = await get_pubs(url)
+    assert pubs[0].select('.title')[0].string == 'Test Title2'
+    assert pubs[0].select('.project')[0].string == 'IceCube'
+
+@pytest.mark.asyncio
+async def test_reuse_port(monkeypatch, port, mongo_client):
+    monkeypatch.setenv('PORT', str(port))
+
+    s1 = pubs.server.create_server(reuse_port=True, run_startup=False)
+    s2 = pubs.server.create_server(reuse_port=True, run_startup=False)
+    try:
+        pubs_list = await get_pubs(f'http://localhost:{port}')
+        assert pubs_list == []
+    finally:
+        await s1.stop(timeout=1)
+        await s2.stop(timeout=1)
+
+@pytest.mark.asyncio
+async def test_manage_import(monkeypatch, port, mongo_client):
+    monkeypatch.setenv('PORT', str(port))
+    monkeypatch.setenv('BASIC_AUTH', 'user:pass')
+    db = mongo_client
+    url = f'http://localhost:{port}'
+
+    csv_data = '''title,authors,type,citation,date,downloads,projects,sites
+foo,"bar, baz, and blah",journal,cite,2020-11-03T00:00:00,baz,icecube,"icecube,wipac"'''
+    files = {'import_file': ('pubs.csv', csv_data, 'text/csv')}
+
+    server = pubs.server.create_server(run_startup=False)
+    try:
+        s = AsyncSession(retries=0, backoff_factor=1)
+        r = await asyncio.wrap_future(s.get(url+'/manage', auth=('user', 'pass')))
+        r.raise_for_status()
+        soup = BeautifulSoup(r.content, 'html.parser')
+        form = soup.select('form.import_form')[0]
+        assert '_xsrf' not in form['action']
+        xsrf = soup.select('input[name="_xsrf"]')[0]['value']
+        headers = {'X-XSRFToken': xsrf}
+
+        r = await asyncio.wrap_future(s.post(url+'/manage/import', files=files, headers=headers))
+        assert r.status_code == 401
+        r = await asyncio.wrap_future(s.post(url+'/manage/import', files=files, headers=headers, auth=('user', 'bad')))
+        assert r.status_code == 403
+        r = await asyncio.wrap_future(s.post(url+'/manage/import', files=files, auth=('user', 'pass')))
+        assert r.status_code == 403
+        assert await db.publications.count_documents({}) == 0
+
+        r = await asyncio.wrap_future(s.post(url+'/manage/import', files=files, headers=headers, auth=('user', 'pass')))
+        r.raise_for_status()
+        soup = BeautifulSoup(r.content, 'html.parser')
+        assert soup.select('.error_box')[0].string == 'Imported 1 new, 0 updated, 0 unchanged publications'
+        assert [p.select('.title')[0].string for p in soup.select('.publication')] == ['foo']
+        assert await db.publications.count_documents({}) == 1
+    finally:
+        await server.stop()
+
+@pytest.mark.asyncio
+async def test_metrics(server):
+    db, url = server
+
+    s = AsyncSession(retries=0, backoff_factor=1)
+    r = await asyncio.wrap_future(s.get(f'{url}/api/publications'))
+    r.raise_for_status()
+    r = await asyncio.wrap_future(s.get(f'{url}/metrics'))
+    r.raise_for_status()
+    assert r.headers['Content-Type'].startswith('text/plain')
+    lines = r.text.splitlines()
+    assert 'pubs_request_duration_seconds_count{handler="APIPubs",status="200"} 1' in lines
+    assert any(line.startswith('pubs_mongo_command_duration_seconds_count{command="find"') for line in lines)
+    assert 'pubs_requests_in_flight{handler="MetricsHandler"} 1' in lines
+
+@pytest.mark.asyncio
+async def test_api_facets(server):
+    db, url = server
+
+    for i in range(5):
+        await add_pub(db, title=f'Test Title{i}', authors=['auth'], abstract='',
+                      pub_type='journal' if i % 2 else 'thesis', citation="TestJournal", date=f'202{i%2}-01-0{i+1}',
+                      downloads=[], projects=['icecube', 'hawc'] if i % 2 else ['hawc'], sites=['wipac'])
+
+    s = AsyncSession(retries=0, backoff_factor=1)
+    r = await asyncio.wrap_future(s.get(url+'/api/publications/facets'))
+    r.raise_for_status()
+    data = r.json()
+    assert data['count'] == 5
+    assert data['type']['journal'] == 2
+    assert data['type']['thesis'] == 3
+    assert data['type']['other'] == 0
+    assert data['projects']['hawc'] == 5
+    assert data['projects']['icecube'] == 2
+    assert data['sites']['wipac'] == 5
+    assert data['year'] == {'2020': 3, '2021': 2}
+
+    r = await asyncio.wrap_future(s.get(url+'/api/publications/facets', params={'projects': 'icecube'}))
+    r.raise_for_status()
+    data = r.json()
+    assert data['count'] == 2
+    assert data['type']['thesis'] == 0
+    assert data['year'] == {'2021': 2}
+
+@pytest.mark.asyncio
+async def test_api_authors_suggest(server):
+    db, url = server
+
+    await add_pub(db, title='Test Title', authors=['Ångström, A.', 'Aartsen, M.'], abstract='',
+                  pub_type="journal", citation="TestJournal", date=nowstr(),
+                  downloads=[], projects=['icecube'])
+
+    s = AsyncSession(retries=0, backoff_factor=1)
+    r = await asyncio.wrap_future(s.get(url+'/api/authors/suggest', params={'prefix': 'ang'}))
+    r.raise_for_status()
+    assert r.json()['authors'] == ['Ångström, A.']
+
+    await add_pub(db, title='Test Title2', authors=['Angelo, B.'], abstract='',
+                  pub_type="journal", citation="TestJournal", date=nowstr(),
+                  downloads=[], projects=['icecube'])
+
+    r = await asyncio.wrap_future(s.get(url+'/api/authors/suggest', params={'prefix': 'ang'}))
+    r.raise_for_status()
+    assert r.json()['authors'] == ['Angelo, B.', 'Ångström, A.']
+
+@pytest.mark.asyncio
+async def test_api_relevance(server):
+    db, url = server
+
+    await add_pub(db, title='Neutrino neutrino flux', authors=['auth'], abstract='',
+                  pub_type="journal", citation="TestJournal", date='2020-01-01',
+                  downloads=[], projects=['icecube'])
+    await add_pub(db, title='Cosmic rays', authors=['auth'], abstract='Not about neutrinos',
+                  pub_type="journal", citation="TestJournal", date='2020-01-02',
+                  downloads=[], projects=['icecube'])
+    await add_pub(db, title='Neutrino oscillations', authors=['auth'], abstract='',
+                  pub_type="journal", citation="TestJournal", date='2020-01-03',
+                  downloads=[], projects=['icecube'])
+
+    s = AsyncSession(retries=0, backoff_factor=1)
+    for with_count in ('false', 'true'):
+        r = await asyncio.wrap_future(s.get(url+'/api/publications', params={'search': 'neutrino', 'sort': 'relevance',
+                                                                           'limit': 2, 'with_count': with_count}))
+        r.raise_for_status()
+        data = r.json()
+        titles = [p['title'] for p in data['publications']]
+        assert titles == ['Neutrino neutrino flux', 'Neutrino oscillations']
+        scores = [p['score'] for p in data['publications']]
+        assert scores[0] > scores[1] > 0
+
+    # without a search, relevance falls back to date
+    r = await asyncio.wrap_future(s.get(url+'/api/publications', params={'sort': 'relevance'}))
+    r.raise_for_status()
+    assert [p['title'] for p in r.json()['publications']][0] == 'Neutrino oscillations'
+
+    r = await asyncio.wrap_future(s.get(url+'/api/publications', params={'sort': 'title'}))
+    assert r.status_code == 400
+
+@pytest.mark.asyncio
+async def test_api_fields(server):
+    db, url = server
+
+    for i in range(3):
+        await add_pub(db, title=f'Test Title{i}', authors=['auth'], abstract='A long abstract',
+                      pub_type="journal", citation="TestJournal", date=f'2020-01-0{i+1}',
+                      downloads=['https://example.com'], projects=['icecube'])
+
+    s = AsyncSession(retries=0, backoff_factor=1)
+    r = await asyncio.wrap_future(s.get(url+'/api/publications', params={'fields': 'title,date'}))
+    r.raise_for_status()
+    data = r.json()
+    assert data['publications'][0] == {'title': 'Test Title2', 'date': '2020-01-03'}
+
+    r = await asyncio.wrap_future(s.get(url+'/api/publications', params={'fields': ['title', '_id'], 'limit': 2}))
+    r.raise_for_status()
+    data = r.json()
+    assert set(data['publications'][0]) == {'_id', 'title'}
+    assert data['after']
+
+    r = await asyncio.wrap_future(s.get(url+'/api/publications', params={'fields': 'title,datetime'}))
+    assert r.status_code == 400
+
+    r = await asyncio.wrap_future(s.get(url+'/csv', params={'fields': 'date,title'}))
+    r.raise_for_status()
+    lines = r.text.strip().split('\n')
+    assert lines[0].strip() == 'title,date'
+    assert lines[1].strip() == 'Test Title2,2020-01-03'
+
+@pytest.mark.asyncio
+async def test_api_bootstrap(server):
+    db, url = server
+
+    for i in range(3):
+        await add_pub(db, title=f'Test Title{i}', authors=['auth'], abstract='',
+                      pub_type="journal", citation="TestJournal", date=f'2020-01-0{i+1}',
+                      downloads=[], projects=['icecube'])
+
+    s = AsyncSession(retries=0, backoff_factor=1)
+    r = await asyncio.wrap_future(s.get(url+'/api/bootstrap', params={'page': 0, 'limit': 2}))
+    r.raise_for_status()
+    assert 'immutable' not in r.headers['Cache-Control']
+    data = r.json()
+    assert data['filter_defaults']['projects'] == []
+    assert data['types'] == pubs.PUBLICATION_TYPES
+    assert data['projects'] == pubs.PROJECTS
+    assert data['count'] == 3
+    assert [p['title'] for p in data['publications']] == ['Test Title2', 'Test Title1']
+
+    r = await asyncio.wrap_future(s.get(url+'/api/bootstrap', params={'page': 0, 'limit': 2, 'v': data['version']}))
+    r.raise_for_status()
+    assert 'immutable' in r.headers['Cache-Control']
+
+    await add_pub(db, title='Test Title3', authors=['auth'], abstract='',
+                  pub_type="journal", citation="TestJournal", date='2020-01-04',
+                  downloads=[], projects=['icecube'])
+
+    r = await asyncio.wrap_future(s.get(url+'/api/bootstrap', params={'page': 0, 'limit': 2, 'v': data['version']}))
+    r.raise_for_status()
+    assert 'immutable' not in r.headers['Cache-Control']
+    assert r.json()['version'] != data['version']
+    assert r.json()['count'] == 4
+
+@pytest.mark.asyncio
+async def test_api_html(server):
+    db, url = server
+
+    await add_pub(db, title='Test Title', authors=['auth'], abstract='An abstract',
+                  pub_type="journal", citation="TestJournal", date=nowstr(),
+                  downloads=[], projects=['icecube'])
+    await add_pub(db, title='Test Title2', authors=['auth'], abstract='',
+                  pub_type="journal", citation="TestJournal", date=nowstr(),
+                  downloads=[], projects=['hawc'])
+
+    s = AsyncSession(retries=0, backoff_factor=1)
+    r = await asyncio.wrap_future(s.get(url+'/api/publications/html', params={'projects': 'icecube'}))
+    r.raise_for_status()
+    assert r.headers['Content-Type'].startswith('text/html')
+    soup = BeautifulSoup(r.content, 'html.parser')
+    articles = soup.select('article.publication')
+    assert len(articles) == 1
+    assert articles[0].select('.title')[0].string == 'Test Title'
+    assert articles[0].select('details .abstract')[0].string == 'An abstract'
+
+    r2 = await asyncio.wrap_future(s.get(url+'/api/publications/html', params={'projects': 'icecube'},
+                                         headers={'If-None-Match': r.headers['Etag']}))
+    assert r2.status_code == 304
+
+    # the main page still renders the script-driven abstract
+    pubs_list = await get_pubs(url, params={'projects': 'icecube'})
+    assert not pubs_list[0].select('details')
+
+@pytest.mark.asyncio
+async def test_api_batch(server):
+    db, url = server
+
+    for i in range(5):
+        await add_pub(db, title=f'Test Title{i}', authors=['auth'], abstract='',
+                      pub_type='journal' if i % 2 else 'thesis', citation="TestJournal", date=f'2020-01-0{i+1}',
+                      downloads=[], projects=['icecube' if i % 2 else 'hawc'])
+
+    queries = [
+        {'projects': 'icecube'},
+        {'projects': ['hawc'], 'limit': 2, 'fields': ['title']},
+        {'type': ['thesis'], 'page': 1, 'limit': 2, 'with_count': False},
+    ]
+    s = AsyncSession(retries=0, backoff_factor=1)
+    r = await asyncio.wrap_future(s.post(url+'/api/publications/batch', json=queries))
+    r.raise_for_status()
+    results = r.json()['results']
+    assert len(results) == 3
+    assert results[0]['count'] == 2
+    assert [p['title'] for p in results[0]['publications']] == ['Test Title3', 'Test Title1']
+    assert results[1]['count'] == 3
+    assert results[1]['publications'] == [{'title': 'Test Title4'}, {'title': 'Test Title2'}]
+    assert 'count' not in results[2]
+    assert [p['title'] for p in results[2]['publications']] == ['Test Title0']
+
+    for bad in ({'foo': 'bar'}, [{'projects': 1}], [{'start_date': 'foo'}], [{'fields': 'foo'}], [{}] * 21):
+        r = await asyncio.wrap_future(s.post(url+'/api/publications/batch', json=bad))
+        assert r.status_code == 400
+
+@pytest.mark.asyncio
+async def test_api_changes(server):
+    db, url = server
+    if 'setName' not in await db.command('isMaster'):
+        pytest.skip('change streams need a replica set')
+
+    data = []
+    connected = asyncio.Event()
+    received = asyncio.Event()
+    check = 'event: insert'
+
+    def on_chunk(chunk):
+        data.append(chunk.decode('utf-8'))
+        if ': connected' in data[0]:
+            connected.set()
+        if check in ''.join(data):
+            received.set()
+
+    client = AsyncHTTPClient(force_instance=True)
+    client.fetch(url+'/api/changes?projects=icecube', streaming_callback=on_chunk, request_timeout=60)
+    await asyncio.wait_for(connected.wait(), 20)
+
+    await add_pub(db, title='Hawc Title', authors=['auth'], abstract='',
+                  pub_type="journal", citation="TestJournal", date=nowstr(),
+                  downloads=[], projects=['hawc'])
+    await add_pub(db, title='IceCube Title', authors=['auth'], abstract='',
+                  pub_type="journal", citation="TestJournal", date=nowstr(),
+                  downloads=[], projects=['icecube'])
+    await asyncio.wait_for(received.wait(), 20)
+
+    events = [json.loads(line[6:]) for line in ''.join(data).split('\n') if line.startswith('data: ')]
+    assert [e['publication']['title'] for e in events] == ['IceCube Title']
+
+    # moved out of the filter
+    received.clear()
+    check = 'event: removed'
+    pub = await db.publications.find_one({'title': 'IceCube Title'})
+    await edit_pub(db, pub['_id'], projects=['hawc'])
+    await asyncio.wait_for(received.wait(), 20)
+    assert f'"_id": "{pub["_id"]}"' in ''.join(data)
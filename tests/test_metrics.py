@@ -0,0 +1,42 @@
+from types import SimpleNamespace
+
+from pubs.cache import QueryCache
+from pubs.metrics import Histogram, Metrics
+
+def test_histogram():
+    h = Histogram('test_seconds', 'help text', ('handler',), buckets=(.1, 1))
+    h.observe(.05, 'a')
+    h.observe(.1, 'a')
+    h.observe(5, 'a')
+    h.observe(.5, 'b"c')
+
+    lines = h.render().splitlines()
+    assert lines[:2] == ['# HELP test_seconds help text', '# TYPE test_seconds histogram']
+    assert 'test_seconds_bucket{handler="a",le="0.1"} 2' in lines
+    assert 'test_seconds_bucket{handler="a",le="1"} 2' in lines
+    assert 'test_seconds_bucket{handler="a",le="+Inf"} 3' in lines
+    assert 'test_seconds_sum{handler="a"} 5.15' in lines
+    assert 'test_seconds_count{handler="a"} 3' in lines
+    assert 'test_seconds_bucket{handler="b\\"c",le="1"} 1' in lines
+
+def test_metrics():
+    cache = QueryCache()
+    cache.set('foo', 1)
+    cache.get('foo')
+    cache.get('bar')
+    m = Metrics(caches={'query': cache})
+
+    m.request_started('Main')
+    m.request_started('Main')
+    m.request_finished('Main', 200, .01)
+    m.command_timer.succeeded(SimpleNamespace(duration_micros=2000, command_name='find'))
+    m.command_timer.failed(SimpleNamespace(duration_micros=3000, command_name='find'))
+
+    lines = m.render().splitlines()
+    assert 'pubs_request_duration_seconds_count{handler="Main",status="200"} 1' in lines
+    assert 'pubs_requests_in_flight{handler="Main"} 1' in lines
+    assert 'pubs_mongo_command_duration_seconds_count{command="find",status="success"} 1' in lines
+    assert 'pubs_mongo_command_duration_seconds_count{command="find",status="failure"} 1' in lines
+    assert 'pubs_cache_hits_total{cache="query"} 1' in lines
+    assert 'pubs_cache_misses_total{cache="query"} 1' in lines
+    assert 'pubs_cache_hit_ratio{cache="query"} 0.5' in lines
@@ -1,7 +1,10 @@
 import asyncio
+from datetime import datetime
+import importlib.util
+import os
 
-from wipac_dev_tools import from_environment
 import pytest
+import pymongo
 from bson.objectid import ObjectId
 
 from pubs import PUBLICATION_TYPES, PROJECTS, SITES
@@ -20,17 +23,50 @@ def test_date_format():
     assert '03 November 2020' == pubs.utils.date_format('2020-11-03T00:00:00')
     assert '03 November 2020' == pubs.utils.date_format('2020-11-03')
 
+def test_content_rev():
+    pub = {'_id': ObjectId(), 'title': 'foo', 'authors': ['bar'], 'date': '2020-11-03', 'datetime': 'ignored'}
+    rev = pubs.utils.content_rev(pub)
+    assert rev == pubs.utils.content_rev({**pub, '_id': ObjectId(), 'datetime': 'other'})
+    assert rev != pubs.utils.content_rev({**pub, 'title': 'foo2'})
+
+def test_display_fields():
+    ret = pubs.utils.display_fields('2020-11-03T01:02:03', ['https://arxiv.org/abs/1234', 'doi.org/foo'])
+    assert ret == {
+        'datetime': datetime(2020, 11, 3, 1, 2, 3),
+        'date_display': '03 November 2020',
+        'download_domains': ['arxiv.org', 'doi.org'],
+    }
+    assert pubs.utils.display_fields(downloads=[]) == {'download_domains': []}
+
+@pytest.mark.asyncio
+async def test_migrate_display_fields(mongo_client):
+    db = mongo_client
+    await db.publications.insert_many([
+        {'title': 'foo', 'date': '2020-11-03', 'downloads': ['https://arxiv.org/abs/1234']},
+        {'title': 'bar', 'date': '2020-11-04T00:00:00', 'downloads': []},
+    ])
+    await pubs.utils.add_pub(db, title='baz', authors=['auth1'], pub_type='journal', abstract='',
+                             citation='cite', date='2020-11-05', downloads=[], projects=['icecube'])
+    assert await pubs.utils.migrate_display_fields(db) == 2
+    assert await pubs.utils.migrate_display_fields(db) == 0
+
+    p = await db.publications.find_one({'title': 'foo'})
+    assert p['datetime'] == datetime(2020, 11, 3)
+    assert p['date_display'] == '03 November 2020'
+    assert p['download_domains'] == ['arxiv.org']
+
 @pytest.mark.asyncio
 async def test_create_indexes(mongo_client):
-    default_config = {
-       'DB_URL': None,
-    }
-    config = from_environment(default_config)
-    db_url, db_name = config['DB_URL'].rsplit('/', 1)
-    pubs.utils.create_indexes(db_url, db_name, background=False)
+    await mongo_client.publications.drop_indexes()
+    await mongo_client.publications.create_index('projects', name='projects_index')
+    status = {}
+    await pubs.utils.create_indexes(mongo_client, background=False, status=status)
 
     indexes = await mongo_client.publications.index_information()
     assert 'text_index' in indexes
+    assert 'projects_index' not in indexes
+    assert status['pending'] == []
+    assert set(status['ready']) == set(pubs.utils.INDEXES)
 
 @pytest.mark.parametrize('sites', [['icecube', 'wipac'], None])
 @pytest.mark.asyncio
@@ -47,6 +83,8 @@ async def test_add_pub(mocker, sites):
         'projects': ['icecube', 'hawc'],
         'sites': sites if sites else []
     }
+    args.update(pubs.utils.display_fields(args['date'], args['downloads']))
+    args['rev'] = pubs.utils.content_rev(args)
     await pubs.utils.add_pub(db, title=args['title'], authors=args['authors'], pub_type=args['type'],
             abstract=args['abstract'], citation=args['citation'], date=args['date'], downloads=args['downloads'],
             projects=args['projects'], sites=sites)
@@ -95,14 +133,20 @@ async def test_edit_pub(mocker, title, authors, pub_type, abstract, citation, da
         args['citation'] = citation
     if date is not None:
         args['date'] = date
+        args.update(pubs.utils.display_fields(date=date))
     if downloads is not None:
         args['downloads'] = downloads
+        args.update(pubs.utils.display_fields(downloads=downloads))
     if projects is not None:
         args['projects'] = projects
     if sites is not None:
         args['sites'] = sites
 
+    old = {'_id': mongo_id, 'title': 'old title', 'authors': ['auth1', 'auth3'], 'type': 'thesis', 'date': '2020-01-01'}
+    args['rev'] = pubs.utils.content_rev({**old, **args})
+
     db = mocker.AsyncMock()
+    db.publications.find_one.return_value = old
     await pubs.utils.edit_pub(db, str(mongo_id), title=title, authors=authors, pub_type=pub_type, abstract=abstract,
             citation=citation, date=date, downloads=downloads, projects=projects, sites=sites)
 
@@ -129,6 +173,7 @@ async def test_edit_pub_err(mocker, title, authors, pub_type, abstract, citation
 @pytest.mark.asyncio
 async def test_import_file_json(mocker):
     db = mocker.AsyncMock()
+    db.publications.bulk_write.return_value = mocker.MagicMock(upserted_count=1, matched_count=0, modified_count=0, upserted_ids={0: ObjectId()})
     json_data = '''{"publications":[{"title":"foo","authors":["bar"],"type":"journal","citation":"cite",
 "date":"2020-11-03T00:00:00","downloads":["baz"],"projects":["icecube"],"sites":["icecube","wipac"]}]}'''
     await pubs.utils.try_import_file(db, json_data)
@@ -144,6 +189,7 @@ async def test_import_file_json(mocker):
 @pytest.mark.asyncio
 async def test_import_file_csv(mocker):
     db = mocker.AsyncMock()
+    db.publications.bulk_write.return_value = mocker.MagicMock(upserted_count=1, matched_count=0, modified_count=0, upserted_ids={0: ObjectId()})
     csv_data = '''title,authors,type,citation,date,downloads,projects,sites
 foo,bar,journal,cite,2020-11-03T00:00:00,baz,icecube,"icecube,wipac"'''
     await pubs.utils.try_import_file(db, csv_data)
@@ -155,6 +201,126 @@ foo,bar,journal,"this is an abstract",cite,2020-11-03T00:00:00,baz,icecube,"icec
 @pytest.mark.asyncio
 async def test_import_file_csv_authors(mocker):
     db = mocker.AsyncMock()
+    db.publications.bulk_write.return_value = mocker.MagicMock(upserted_count=1, matched_count=0, modified_count=0, upserted_ids={0: ObjectId()})
     csv_data = '''title,authors,type,citation,date,downloads,projects,sites
 foo,"bar, baz, and blah",journal,cite,2020-11-03T00:00:00,baz,icecube,"icecube,wipac"'''
     await pubs.utils.try_import_file(db, csv_data)
+
+def test_after_token():
+    mongo_id = ObjectId()
+    date = datetime(2020, 11, 3, 1, 2, 3, 456)
+    token = pubs.utils.encode_after_token(date, mongo_id)
+    assert isinstance(token, str)
+    assert pubs.utils.decode_after_token(token) == (date, mongo_id)
+
+    token = pubs.utils.encode_after_token(None, mongo_id)
+    assert pubs.utils.decode_after_token(token) == (None, mongo_id)
+
+@pytest.mark.parametrize('token', ['', 'foo', 'WyIyMDIwIiwiYmFkIl0'])
+def test_after_token_err(token):
+    with pytest.raises(Exception):
+        pubs.utils.decode_after_token(token)
+
+@pytest.mark.asyncio
+async def test_delete_pub(mocker):
+    mongo_id = ObjectId()
+    db = mocker.AsyncMock()
+    db.publications.find_one_and_delete.return_value = {'_id': mongo_id, 'authors': ['auth1']}
+    await pubs.utils.delete_pub(db, str(mongo_id))
+    db.publications.find_one_and_delete.assert_called_once_with({'_id': mongo_id}, projection={'authors': True})
+    db.authors.bulk_write.assert_called_once()
+
+@pytest.mark.asyncio
+async def test_revision(mocker):
+    db = mocker.AsyncMock()
+    db.metadata.find_one.return_value = None
+    assert await pubs.utils.get_revision(db) == (0, None)
+
+    await pubs.utils.bump_revision(db)
+    db.metadata.update_one.assert_called_once()
+    assert db.metadata.update_one.call_args.args[0] == {'_id': 'revision'}
+
+    db.metadata.find_one.return_value = {'_id': 'revision', 'revision': 3, 'modified': 'now'}
+    assert await pubs.utils.get_revision(db) == (3, 'now')
+
+@pytest.mark.asyncio
+async def test_update_authors(mocker):
+    db = mocker.AsyncMock()
+    await pubs.utils.update_authors(db, added=['auth1', 'auth2'], removed=['auth2', 'auth3'])
+    ops = db.authors.bulk_write.call_args.args[0]
+    assert sorted((op._filter['_id'], op._doc['$inc']['count']) for op in ops) == [('auth1', 1), ('auth3', -1)]
+    db.authors.delete_many.assert_called_once_with({'count': {'$lte': 0}})
+
+    db = mocker.AsyncMock()
+    await pubs.utils.update_authors(db, added=['auth1'], removed=['auth1'])
+    db.authors.bulk_write.assert_not_called()
+    db.authors.delete_many.assert_not_called()
+
+@pytest.mark.asyncio
+async def test_authors_registry(mongo_client):
+    db = mongo_client
+    await pubs.utils.add_pub(db, title='foo', authors=['auth1', 'auth2'], pub_type='journal', abstract='',
+                             citation='cite', date='2020-11-03', downloads=[], projects=['icecube'])
+    await pubs.utils.add_pub(db, title='bar', authors=['auth1'], pub_type='journal', abstract='',
+                             citation='cite', date='2020-11-03', downloads=[], projects=['icecube'])
+
+    async def get_authors():
+        return {row['_id']: row['count'] async for row in db.authors.find({})}
+
+    assert await get_authors() == {'auth1': 2, 'auth2': 1}
+
+    pub = await db.publications.find_one({'title': 'foo'})
+    await pubs.utils.edit_pub(db, pub['_id'], authors=['auth1', 'auth3'])
+    assert await get_authors() == {'auth1': 2, 'auth3': 1}
+
+    await pubs.utils.delete_pub(db, pub['_id'])
+    assert await get_authors() == {'auth1': 1}
+
+    await db.authors.drop()
+    await pubs.utils.rebuild_authors(db)
+    assert await get_authors() == {'auth1': 1}
+
+@pytest.mark.asyncio
+async def test_migrate_authors(mongo_client):
+    db = mongo_client
+    assert not await pubs.utils.migrate_authors(db)
+
+    await pubs.utils.add_pub(db, title='foo', authors=['auth1', 'auth2'], pub_type='journal', abstract='',
+                             citation='cite', date='2020-11-03', downloads=[], projects=['icecube'])
+    assert not await pubs.utils.migrate_authors(db)
+
+    # an existing database, from before the registry
+    await db.authors.drop()
+    revision, _ = await pubs.utils.get_revision(db)
+    assert await pubs.utils.migrate_authors(db)
+    assert {row['_id']: row['count'] async for row in db.authors.find({})} == {'auth1': 1, 'auth2': 1}
+    assert (await pubs.utils.get_revision(db))[0] > revision
+
+def test_rebuild_authors_script():
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'resources', 'rebuild_authors.py')
+    spec = importlib.util.spec_from_file_location('rebuild_authors', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    assert module.config['DB_URL']
+    assert module.rebuild_authors is pubs.utils.rebuild_authors
+
+@pytest.mark.asyncio
+async def test_import_file_batches(mocker):
+    db = mocker.AsyncMock()
+    db.publications.bulk_write.side_effect = [
+        mocker.MagicMock(upserted_count=1, matched_count=1, modified_count=1, upserted_ids={1: ObjectId()}),
+        mocker.MagicMock(upserted_count=0, matched_count=1, modified_count=0, upserted_ids={}),
+    ]
+    csv_data = '''title,authors,type,citation,date,downloads,projects,sites
+foo,bar,journal,cite,2020-11-03T00:00:00,baz,icecube,"icecube,wipac"
+foo2,bar,journal,cite,2020-11-03T00:00:00,baz,icecube,"icecube,wipac"
+foo3,bar,journal,cite,2020-11-03T00:00:00,baz,icecube,"icecube,wipac"'''
+    ret = await pubs.utils.try_import_file(db, csv_data, batch_size=2)
+    assert ret == {'inserted': 1, 'updated': 1, 'unchanged': 1}
+
+    assert db.publications.bulk_write.call_count == 2
+    ops = db.publications.bulk_write.call_args_list[0].args[0]
+    assert len(ops) == 2
+    assert isinstance(ops[0], pymongo.ReplaceOne)
+    assert db.publications.bulk_write.call_args_list[0].kwargs == {'ordered': False}
+    db.metadata.update_one.assert_called_once()
@@ -36,11 +36,15 @@ async def mongo_client(monkeypatch):
     ret = db[db_name]
 
     await ret.publications.drop()
-    create_indexes(db_url, db_name, background=False)
+    await ret.metadata.drop()
+    await ret.authors.drop()
+    await create_indexes(ret, background=False)
     try:
         yield ret
     finally:
         await ret.publications.drop()
+        await ret.metadata.drop()
+        await ret.authors.drop()
 
 @pytest_asyncio.fixture
 async def server(monkeypatch, port, mongo_client):